@@ -0,0 +1,345 @@
+import numpy as np
+from bitboard import KINDS
+import zobrist
+
+# Ray directions for the sliding pieces, in the same order get_valid_moves walks them
+SLIDER_DIRECTIONS = {
+    "Queen": ((0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1)),
+    "Rook": ((0, -1), (1, 0), (0, 1), (-1, 0)),
+    "Bishop": ((1, -1), (1, 1), (-1, 1), (-1, -1)),
+}
+KNIGHT_OFFSETS = ((1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1), (-1, -2))
+OFF_BOARD = 64 # Square index padding the tables below where a ray or jump leaves the board
+
+
+# Int8 code of a piece in Board.codes: the bitboard kind plus one, negative for black, 0 for an empty square
+def piece_code(piece):
+    if piece is None:
+        return 0
+    code = KINDS[piece.name] + 1
+    return code if piece.color == "White" else -code
+
+
+def _ray_table():
+    rays = np.full((64, 8, 7), OFF_BOARD, np.int64)
+    for direction, (dx, dy) in enumerate(SLIDER_DIRECTIONS["Queen"]):
+        for square in range(64):
+            x = square & 7
+            y = square >> 3
+            for step in range(7):
+                x += dx
+                y += dy
+                if not (0 <= x < 8 and 0 <= y < 8):
+                    break
+                rays[square, direction, step] = y * 8 + x
+    return rays
+
+
+def _offset_table(offsets):
+    targets = np.full((64, len(offsets)), OFF_BOARD, np.int64)
+    for square in range(64):
+        for index, (dx, dy) in enumerate(offsets):
+            x = (square & 7) + dx
+            y = (square >> 3) + dy
+            if 0 <= x < 8 and 0 <= y < 8:
+                targets[square, index] = y * 8 + x
+    return targets
+
+
+# Like get_valid_moves, the double step is not bounds checked and wraps around the board
+def _double_step_table():
+    targets = np.full((2, 64), OFF_BOARD, np.int64)
+    for color, direction in enumerate((-1, 1)):
+        for square in range(64):
+            y = (square >> 3) + direction
+            if 0 <= y < 8:
+                targets[color, square] = (y + direction) % 8 * 8 + (square & 7)
+    return targets
+
+
+# RAYS[square, direction] lists the squares outward from square, in the Queen direction order
+RAYS = _ray_table()
+KNIGHT_TARGETS = _offset_table(KNIGHT_OFFSETS)
+# Pawn tables by color, 0 for white moving up and 1 for black moving down
+PAWN_PUSHES = np.stack((_offset_table(((0, -1),))[:, 0], _offset_table(((0, 1),))[:, 0]))
+PAWN_DOUBLE_STEPS = _double_step_table()
+PAWN_CAPTURES = np.stack((_offset_table(((-1, -1), (1, -1))), _offset_table(((-1, 1), (1, 1)))))
+# Which of the eight directions each piece code slides along, by absolute code
+SLIDES = np.zeros((7, 8), bool)
+SLIDES[KINDS["Bishop"] + 1, 1::2] = True
+SLIDES[KINDS["Rook"] + 1, 0::2] = True
+SLIDES[KINDS["Queen"] + 1, :] = True
+
+
+# Works out what every piece except the kings marks on its team's map, all pieces at once.
+# codes is Board.codes flattened, unmoved flags the squares of pawns that can still double step
+# and en_passant is the square of the pawn that can be captured en passant, or None. Marks
+# follow AttackMap.scan. Returns two arrays: the square of the marking piece and the marked square
+def vector_marks(codes, unmoved, en_passant):
+    kinds = np.abs(codes)
+    occupied = np.append(codes != 0, True) # The padding square stops every ray
+    on_board = np.append(np.ones(64, bool), False)
+
+    sliders = np.flatnonzero((kinds >= 3) & (kinds <= 5))
+    rays = RAYS[sliders] # Piece, direction, step
+    blockers = occupied[rays]
+    # A ray marks every square up to and including the first occupied one
+    reached = (np.cumsum(blockers, axis=2) <= blockers) & on_board[rays] & SLIDES[kinds[sliders]][:, :, None]
+    slider_sources = np.broadcast_to(sliders[:, None, None], rays.shape)[reached]
+    slider_targets = rays[reached]
+
+    knights = np.flatnonzero(kinds == 2)
+    jumps = KNIGHT_TARGETS[knights]
+    reached = on_board[jumps]
+    knight_sources = np.broadcast_to(knights[:, None], jumps.shape)[reached]
+    knight_targets = jumps[reached]
+
+    pawns = np.flatnonzero(kinds == 1)
+    colors = (codes[pawns] < 0).astype(np.intp)
+    pushes = PAWN_PUSHES[colors, pawns]
+    push = on_board[pushes] & ~occupied[pushes]
+    doubles = PAWN_DOUBLE_STEPS[colors, pawns]
+    double = push & unmoved[pawns] & ~occupied[doubles]
+    captures = PAWN_CAPTURES[colors, pawns]
+    capture = on_board[captures] & occupied[captures]
+    sources = [slider_sources, knight_sources, pawns[push], pawns[double],
+               np.broadcast_to(pawns[:, None], captures.shape)[capture]]
+    targets = [slider_targets, knight_targets, pushes[push], doubles[double], captures[capture]]
+    if en_passant is not None:
+        # Pawns beside the en passant pawn mark the square behind it, unless a piece standing there is already marked
+        behind = PAWN_PUSHES[colors, en_passant]
+        beside = ((pawns >> 3) == en_passant >> 3) & (np.abs((pawns & 7) - (en_passant & 7)) == 1) \
+            & (np.sign(codes[pawns]) != np.sign(codes[en_passant])) & ~occupied[behind]
+        sources.append(pawns[beside])
+        targets.append(behind[beside])
+    return np.concatenate(sources), np.concatenate(targets)
+
+
+# Keeps board.white_spaces/board.black_spaces up to date incrementally.
+# Every piece except the kings caches the squares it marks on its team's map
+# (its moves plus the friendly pieces it defends) and the squares those marks
+# depend on. After a move only the pieces watching a changed square are
+# rescanned; the kings are still recomputed with get_valid_moves because their
+# marks depend on the whole opposing map.
+class AttackMap:
+    def __init__(self, board, debug=False):
+        self.board = board
+        self.debug = debug # Cross-check every update against the full recompute
+        self.marks = {}
+        self.watching = {}
+        self.index = [[set() for x in range(8)] for y in range(8)] # Square -> pieces watching it
+        self.counts = {"White": np.zeros((8, 8), int), "Black": np.zeros((8, 8), int)}
+        self.touched = set()
+        self.dirty = set()
+        self.en_passant = None
+
+    # Records that the contents of a square changed since the last update
+    def touch(self, x, y):
+        self.touched.add((x, y))
+
+    # Forces a piece to be rescanned on the next update
+    def invalidate(self, piece):
+        if piece.name != "King":
+            self.dirty.add(piece)
+
+    # Drops a piece that has left the board
+    def discard(self, piece):
+        self.dirty.discard(piece)
+        self.forget(piece)
+
+    def forget(self, piece):
+        marks = self.marks.pop(piece, None)
+        if marks is None:
+            return
+        counts = self.counts[piece.color]
+        for x, y in marks:
+            counts[y][x] -= 1
+        for x, y in self.watching.pop(piece):
+            self.index[y][x].discard(piece)
+
+    def learn(self, piece):
+        marks, depends = self.scan(piece)
+        self.marks[piece] = marks
+        watching = set(marks)
+        watching.update(depends)
+        self.watching[piece] = watching
+        counts = self.counts[piece.color]
+        for x, y in marks:
+            counts[y][x] += 1
+        for x, y in watching:
+            self.index[y][x].add(piece)
+
+    # Returns the squares a piece marks and the extra squares its marks depend on.
+    # Mirrors what get_valid_moves writes into the team map for non king pieces
+    def scan(self, piece):
+        board = self.board.board
+        x = piece.x
+        y = piece.y
+        marks = []
+        if piece.name == "Knight":
+            for dx, dy in KNIGHT_OFFSETS:
+                if 0 <= x + dx < 8 and 0 <= y + dy < 8:
+                    marks.append((x + dx, y + dy))
+            # Knights mark every reachable square whether it is empty, friendly or not
+            return marks, ()
+        if piece.name == "Pawn":
+            depends = []
+            direction = piece.direction
+            new_y = y + direction
+            if 0 <= new_y < 8:
+                depends.append((x, new_y))
+                if board[new_y][x] is None:
+                    marks.append((x, new_y))
+                    if not piece.moved:
+                        # get_valid_moves does not bounds check the double step, row -1 wraps to 7
+                        far_y = (new_y + direction) % 8
+                        depends.append((x, far_y))
+                        if board[new_y + direction][x] is None:
+                            marks.append((x, far_y))
+                for new_x in (x - 1, x + 1):
+                    if 0 <= new_x < 8:
+                        depends.append((new_x, new_y))
+                        if board[new_y][new_x] is not None:
+                            marks.append((new_x, new_y))
+            en_passant = self.board.en_passant
+            if en_passant is not None and en_passant.color != piece.color and en_passant.y == y:
+                if en_passant.x == x - 1 or en_passant.x == x + 1:
+                    space = (en_passant.x, y + direction)
+                    if space not in marks:
+                        marks.append(space)
+            return marks, depends
+        for dx, dy in SLIDER_DIRECTIONS[piece.name]:
+            new_x = x + dx
+            new_y = y + dy
+            while 0 <= new_x < 8 and 0 <= new_y < 8:
+                marks.append((new_x, new_y))
+                if board[new_y][new_x] is not None:
+                    break
+                new_x += dx
+                new_y += dy
+        # A ray only changes when one of the squares it reaches changes
+        return marks, ()
+
+    # Rescans the pieces affected since the last update, then rebuilds both maps and the check state
+    def update(self):
+        board = self.board
+        affected = self.dirty
+        for x, y in self.touched:
+            affected.update(self.index[y][x])
+        en_passant = board.en_passant
+        key = None if en_passant is None else (en_passant, en_passant.x, en_passant.y)
+        if key != self.en_passant:
+            # Pawns beside the old or new en passant pawn gain or lose a capture square
+            for old in (self.en_passant, key):
+                if old is None:
+                    continue
+                pieces = board.black_pieces if old[0].color == "White" else board.white_pieces
+                for piece in pieces.of_type("Pawn"):
+                    if piece.y == old[2] and abs(piece.x - old[1]) == 1:
+                        affected.add(piece)
+            self.en_passant = key
+        for piece in affected:
+            self.forget(piece)
+            self.learn(piece)
+        self.touched = set()
+        self.dirty = set()
+
+        board.white_spaces = (self.counts["White"] > 0).astype(float)
+        board.black_spaces = (self.counts["Black"] > 0).astype(float)
+        # The full recompute visits the white pieces first, so a black attacker overwrites a white one
+        for king, pieces in ((board.black_king, board.white_pieces), (board.white_king, board.black_pieces)):
+            if king is None or board.get_space(king.x, king.y) is not king:
+                continue
+            attackers = [piece for piece in self.index[king.y][king.x]
+                         if piece.color != king.color and (king.x, king.y) in self.marks[piece]]
+            if attackers:
+                board.check = True
+                board.attacking_piece = max(attackers, key=pieces.index)
+        board.white_king.get_valid_moves(board)
+        board.black_king.get_valid_moves(board)
+        if self.debug:
+            self.verify()
+
+    # Compares the incremental result with a full recompute of every piece
+    def verify(self):
+        board = self.board
+        white_spaces = board.white_spaces
+        black_spaces = board.black_spaces
+        check = board.check
+        attacking_piece = board.attacking_piece
+        board.compute_spaces()
+        if not np.array_equal(white_spaces, board.white_spaces):
+            raise AssertionError("Incremental white attack map differs from full recompute:\n%s\n%s" % (white_spaces, board.white_spaces))
+        if not np.array_equal(black_spaces, board.black_spaces):
+            raise AssertionError("Incremental black attack map differs from full recompute:\n%s\n%s" % (black_spaces, board.black_spaces))
+        if check != board.check or (check and attacking_piece is not board.attacking_piece):
+            raise AssertionError("Incremental check state differs from full recompute: %s %s, %s %s"
+                                 % (check, attacking_piece, board.check, board.attacking_piece))
+        if board.hash != zobrist.hash_board(board):
+            raise AssertionError("Incremental hash %x differs from full recompute %x" % (board.hash, zobrist.hash_board(board)))
+
+
+# Drop-in replacement for AttackMap that recomputes both maps from Board.codes on every update
+# with vector_marks instead of tracking which pieces a move affected. It also counts the squares
+# each piece marks, its moves plus the friendly pieces it defends, in mobility
+# Used by a Board with backend="bitboard", where the position answers every attack question.
+# Nothing is tracked and Board.white_spaces and Board.black_spaces come from the position
+class NullAttackMap:
+    def __init__(self, board, debug=False):
+        self.debug = debug
+
+    def touch(self, x, y):
+        pass
+
+    def invalidate(self, piece):
+        pass
+
+    def discard(self, piece):
+        pass
+
+    def update(self):
+        pass
+
+
+class VectorAttackMap(AttackMap):
+    def __init__(self, board, debug=False):
+        self.board = board
+        self.debug = debug
+        self.mobility = np.zeros(64, int) # Square -> squares marked by the piece on it, kings excluded
+
+    # Nothing to track, update looks at the whole board
+    def touch(self, x, y):
+        pass
+
+    def invalidate(self, piece):
+        pass
+
+    def discard(self, piece):
+        pass
+
+    def update(self):
+        board = self.board
+        codes = board.codes.ravel()
+        unmoved = np.zeros(64, bool)
+        for piece in [*board.white_pieces.of_type("Pawn"), *board.black_pieces.of_type("Pawn")]:
+            if not piece.moved:
+                unmoved[piece.y * 8 + piece.x] = True
+        en_passant = board.en_passant
+        en_passant = None if en_passant is None else en_passant.y * 8 + en_passant.x
+        sources, targets = vector_marks(codes, unmoved, en_passant)
+        white = codes[sources] > 0
+        board.white_spaces = (np.bincount(targets[white], minlength=64) > 0).reshape(8, 8).astype(float)
+        board.black_spaces = (np.bincount(targets[~white], minlength=64) > 0).reshape(8, 8).astype(float)
+        self.mobility = np.bincount(sources, minlength=64)
+        # The full recompute visits the white pieces first, so a black attacker overwrites a white one
+        for king, pieces, attacking in ((board.black_king, board.white_pieces, white), (board.white_king, board.black_pieces, ~white)):
+            if king is None or board.get_space(king.x, king.y) is not king:
+                continue
+            attackers = sources[attacking & (targets == king.y * 8 + king.x)]
+            if len(attackers):
+                board.check = True
+                board.attacking_piece = max((board.get_space(square & 7, square >> 3) for square in attackers), key=pieces.index)
+        board.white_king.get_valid_moves(board)
+        board.black_king.get_valid_moves(board)
+        if self.debug:
+            self.verify()
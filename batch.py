@@ -0,0 +1,338 @@
+import argparse
+import random
+import time
+import numpy as np
+from attacks import SLIDER_DIRECTIONS, KNIGHT_OFFSETS, RAYS, OFF_BOARD
+from bitboard import (WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, KNIGHT_ATTACKS, KING_ATTACKS,
+                      PAWN_ATTACKS, WHITE_KING_SIDE)
+
+# Move generation for many positions at once. A batch of N positions is four arrays:
+#   codes     N x 8 x 8 int8, the piece codes of Board.codes (bitboard kind plus one, negative for black)
+#   turn      N, the side to move, WHITE or BLACK
+#   castling  N, castling rights bits as in bitboard
+#   ep        N, the square a pawn can capture onto en passant, or -1
+# The rules are the full ones the bitboard backend follows, pins included, and moves are
+# packed like bitboard moves: from square | to square << 6 | promotion kind << 12.
+
+# BIT[square] is the bitboard of one square, the off board padding square has none
+BIT = np.array([1 << square for square in range(64)] + [0], np.uint64)
+KNIGHT_MASKS = np.array(KNIGHT_ATTACKS + (0,), np.uint64)
+KING_MASKS = np.array(KING_ATTACKS + (0,), np.uint64)
+PAWN_MASKS = np.array([attacks + (0,) for attacks in PAWN_ATTACKS], np.uint64) # Squares a pawn of each color attacks
+PAWN_PUSHES = np.zeros((2, 65), np.uint64)
+PAWN_PUSHES[WHITE, 8:64] = BIT[:56]
+PAWN_PUSHES[BLACK, :56] = BIT[8:64]
+START_ROWS = np.stack((np.arange(65) >> 3 == 6, np.arange(65) >> 3 == 1)) # Where each color's pawns may double step from
+FULL = np.uint64((1 << 64) - 1)
+PROMOTIONS = np.array((QUEEN, ROOK, BISHOP, KNIGHT))
+CHUNK = 1 << 13 # Positions worked on at once, bounds the temporary arrays
+
+
+# The square index step of a move by (dx, dy) and the squares it may land on, so that a
+# bitboard shifted sideways does not wrap around onto the far files
+def _step(dx, dy):
+    files = np.arange(64) & 7
+    landing = (files >= dx) & (files < 8 + dx)
+    return dy * 8 + dx, np.uint64(np.bitwise_or.reduce(np.where(landing, BIT[:64], np.uint64(0))))
+
+
+STEPS = [_step(dx, dy) for dx, dy in SLIDER_DIRECTIONS["Queen"]] # Rook directions at even indices, bishop ones at odd
+KNIGHT_STEPS = [_step(dx, dy) for dx, dy in KNIGHT_OFFSETS]
+PAWN_CAPTURE_DIRECTIONS = ((7, 1), (5, 3)) # Directions of the captures of each color's pawns, in STEPS
+
+
+def shift(bits, step):
+    return bits << np.uint64(step) if step > 0 else bits >> np.uint64(-step)
+
+
+# Returns the squares reached by one jump by each of steps from the squares in bits
+def leaps(bits, steps):
+    reach = np.zeros_like(bits)
+    for step, landing in steps:
+        reach |= shift(bits, step) & landing
+    return reach
+
+
+# Returns the squares the sliders in bits reach going in direction, up to and including the first
+# occupied square. Works on whole arrays of bitboards, three doubling fills covering the seven steps
+def slide(bits, empty, direction):
+    step, landing = STEPS[direction]
+    empty = empty & landing
+    bits = bits | (empty & shift(bits, step))
+    empty = empty & shift(empty, step)
+    bits = bits | (empty & shift(bits, 2 * step))
+    empty = empty & shift(empty, 2 * step)
+    bits = bits | (empty & shift(bits, 4 * step))
+    return shift(bits, step) & landing
+
+
+# Packs the last axis of a boolean array of 64 squares into bitboards
+def to_bitboards(squares):
+    packed = np.packbits(squares, axis=-1, bitorder="little")
+    return packed.view("<u8")[..., 0].astype(np.uint64)
+
+
+# Returns whether each square is attacked by the pieces in enemy (an M x 6 array of bitboards
+# by kind) with the given occupancy. color is the side the square belongs to
+def attacked(squares, color, occupied, enemy):
+    hits = (KNIGHT_MASKS[squares] & enemy[:, KNIGHT]) | (KING_MASKS[squares] & enemy[:, KING]) \
+        | (PAWN_MASKS[color, squares] & enemy[:, PAWN])
+    # The first occupied square along each ray from the square, or the padding square
+    rays = RAYS[squares]
+    blocked = (occupied[:, None, None] & BIT[rays]) != 0
+    first = np.where(blocked.any(2), np.take_along_axis(rays, blocked.argmax(2)[:, :, None], 2)[:, :, 0], OFF_BOARD)
+    blockers = BIT[first]
+    straight = np.bitwise_or.reduce(blockers[:, 0::2], axis=1)
+    diagonal = np.bitwise_or.reduce(blockers[:, 1::2], axis=1)
+    hits |= straight & (enemy[:, ROOK] | enemy[:, QUEEN])
+    hits |= diagonal & (enemy[:, BISHOP] | enemy[:, QUEEN])
+    return hits != 0
+
+
+# Returns every legal move of the side to move in each position as two flat arrays: the index
+# of the position each move belongs to and the packed move, grouped by position. Instead of
+# trying each move, the checks, pins and attacked squares of each position are worked out once
+# and the pseudo legal targets of every piece are masked with them
+def legal_moves(codes, turn, castling, ep):
+    count = len(codes)
+    codes = np.asarray(codes, np.int8).reshape(count, 64)
+    turn = np.asarray(turn, np.intp)
+    castling = np.asarray(castling, np.intp)
+    ep = np.asarray(ep, np.intp)
+    if count <= CHUNK:
+        return _legal_moves(codes, turn, castling, ep)
+    boards = []
+    moves = []
+    for start in range(0, count, CHUNK):
+        part = slice(start, start + CHUNK)
+        board, move = _legal_moves(codes[part], turn[part], castling[part], ep[part])
+        boards.append(board + start)
+        moves.append(move)
+    return np.concatenate(boards), np.concatenate(moves)
+
+
+# legal_moves for one chunk of positions
+def _legal_moves(codes, turn, castling, ep):
+    count = len(codes)
+    rows = np.arange(count)
+    squares = np.arange(64)
+    kinds = np.abs(codes).astype(np.intp) - 1 # Bitboard kind, -1 for empty
+    mine = np.where(turn[:, None] == WHITE, codes > 0, codes < 0)
+    theirs = (codes != 0) & ~mine
+    own = to_bitboards(mine)
+    occupied = to_bitboards(codes != 0)
+    enemy = np.stack([to_bitboards(theirs & (kinds == kind)) for kind in range(6)], 1)
+    kings = np.where(mine & (kinds == KING), squares, OFF_BOARD).min(1)
+    has_king = kings < 64
+    king = BIT[kings] # Empty without a king
+    straight = enemy[:, ROOK] | enemy[:, QUEEN] # Enemy sliders along each kind of direction
+    diagonal = enemy[:, BISHOP] | enemy[:, QUEEN]
+
+    # Pseudo legal targets of every piece of the side to move, one bitboard per square. En
+    # passant captures are left out and checked one by one at the end
+    targets = np.zeros((count, 64), np.uint64)
+    for kind, masks in ((KNIGHT, KNIGHT_MASKS), (KING, KING_MASKS)):
+        board, square = np.nonzero(mine & (kinds == kind))
+        targets[board, square] = masks[square]
+    board, square = np.nonzero(mine & (kinds >= BISHOP) & (kinds <= QUEEN))
+    kind = kinds[board, square]
+    bits = BIT[square]
+    empty = ~occupied[board]
+    along = (np.where((kind == ROOK) | (kind == QUEEN), bits, np.uint64(0)),
+             np.where((kind == BISHOP) | (kind == QUEEN), bits, np.uint64(0)))
+    reach = np.zeros(len(board), np.uint64)
+    for direction in range(8):
+        reach |= slide(along[direction % 2], empty, direction)
+    targets[board, square] = reach
+    board, square = np.nonzero(mine & (kinds == PAWN))
+    color = turn[board]
+    empty = ~occupied[board]
+    single = PAWN_PUSHES[color, square] & empty
+    double = np.where(START_ROWS[color, square], np.where(color == WHITE, single >> np.uint64(8), single << np.uint64(8)) & empty, np.uint64(0))
+    targets[board, square] = single | double | (PAWN_MASKS[color, square] & occupied[board] & ~own[board])
+    targets &= ~own[:, None]
+    king_targets = targets[rows, np.minimum(kings, 63)]
+
+    # Squares the opponent attacks, seen through the king so it cannot step back along a checking ray
+    empty = ~occupied | king
+    danger = leaps(enemy[:, KNIGHT], KNIGHT_STEPS) | leaps(enemy[:, KING], STEPS)
+    for direction in range(8):
+        danger |= slide((straight, diagonal)[direction % 2], empty, direction)
+    for color, directions in enumerate(PAWN_CAPTURE_DIRECTIONS):
+        pawns = np.where(turn != color, enemy[:, PAWN], np.uint64(0))
+        danger |= leaps(pawns, [STEPS[direction] for direction in directions])
+
+    # Checks and pins along the eight rays from the king: the first piece met is a checker if it
+    # is an enemy slider moving that way, or pinned if it is ours and such a slider is next
+    empty = ~occupied
+    knights = KNIGHT_MASKS[kings] & enemy[:, KNIGHT]
+    pawns = PAWN_MASKS[turn, kings] & enemy[:, PAWN]
+    checks = (knights != 0).astype(np.intp) + (pawns != 0)
+    blocks = knights | pawns
+    pinned = []
+    for direction in range(8):
+        sliders = (straight, diagonal)[direction % 2]
+        to_first = slide(king, empty, direction)
+        first = to_first & occupied
+        to_second = slide(king, empty | first, direction)
+        checking = first & sliders != 0
+        checks += checking
+        blocks |= np.where(checking, to_first, np.uint64(0))
+        board = np.flatnonzero((first & own != 0) & (to_second & ~first & sliders != 0))
+        pinned.append((board, first[board], to_second[board]))
+    # With one checker the other pieces must capture it or block its ray, with two only the king can move
+    targets &= np.where(checks == 0, FULL, np.where(checks == 1, blocks, np.uint64(0)))[:, None]
+    for board, first, line in pinned:
+        targets[board, np.log2(first.astype(np.float64)).astype(np.intp)] &= line
+    targets[rows[has_king], kings[has_king]] = king_targets[has_king] & ~danger[has_king]
+
+    # One row per move, taken from the set bits of the target bitboards
+    board, square = np.nonzero(targets)
+    bits = np.unpackbits(targets[board, square].astype("<u8").view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    row, to = np.nonzero(bits.view(bool))
+    board = board[row]
+    frm = square[row]
+    moves = frm | to << 6
+    promoting = (kinds[board, frm] == PAWN) & ((to < 8) | (to >= 56))
+    passant_board, passant = en_passant_moves(turn, ep, kinds, mine, occupied, enemy, kings)
+    castles_board, castles = castling_moves(turn, castling, kings, kinds, mine, occupied, danger)
+    board = np.concatenate((board[~promoting], np.repeat(board[promoting], 4), passant_board, castles_board))
+    moves = np.concatenate((moves[~promoting], (np.repeat(moves[promoting], 4).reshape(-1, 4) | PROMOTIONS << 12).ravel(),
+                            passant, castles))
+    order = np.argsort(board, kind="stable")
+    return board[order], moves[order]
+
+
+# Returns the en passant captures as (position index, packed move) arrays. There are few, so
+# each is tried on its own, which also covers the pawns leaving the king's row together
+def en_passant_moves(turn, ep, kinds, mine, occupied, enemy, kings):
+    board, frm = np.nonzero(mine & (kinds == PAWN) & (ep[:, None] >= 0))
+    board = board.astype(np.intp)
+    to = ep[board]
+    capture = PAWN_MASKS[turn[board], frm] & BIT[np.where(to >= 0, to, OFF_BOARD)] != 0
+    board = board[capture]
+    frm = frm[capture]
+    to = to[capture]
+    safe = ~leaves_king_attacked(board, frm, to, turn, kinds, ep, occupied, enemy, kings)
+    return board[safe], (frm | to << 6)[safe]
+
+
+# Returns whether each move (position index, from, to) would leave its own king attacked
+def leaves_king_attacked(board, frm, to, turn, kinds, ep, occupied, enemy, kings):
+    color = turn[board]
+    king = np.where(frm == kings[board], to, kings[board])
+    removed = BIT[to]
+    en_passant = (kinds[board, frm] == PAWN) & (to == ep[board])
+    victim = np.where(en_passant, np.where(color == WHITE, to + 8, to - 8), OFF_BOARD)
+    removed |= BIT[victim]
+    after = (occupied[board] & ~BIT[frm] & ~BIT[victim]) | BIT[to]
+    # Positions without a king of the side to move have nothing to leave attacked
+    return attacked(np.minimum(king, 63), color, after, enemy[board] & ~removed[:, None]) & (king < 64)
+
+
+# Returns the castling moves as (position index, packed move) arrays. The king must be home
+# with the rook in its corner, the squares between them empty and the king's path not in danger
+def castling_moves(turn, castling, kings, kinds, mine, occupied, danger):
+    boards = []
+    moves = []
+    home = np.where(turn == WHITE, 60, 4)
+    rights = np.where(turn == WHITE, castling, castling >> 2) & 3
+    for right, rook, between, path in ((WHITE_KING_SIDE, 3, (1, 2), (0, 1, 2)), (WHITE_KING_SIDE << 1, -4, (-1, -2, -3), (0, -1, -2))):
+        candidate = (rights & right != 0) & (kings == home)
+        candidate &= mine[np.arange(len(turn)), home + rook] & (kinds[np.arange(len(turn)), home + rook] == ROOK)
+        for offset in between:
+            candidate &= occupied & BIT[home + offset] == 0
+        for offset in path:
+            candidate &= danger & BIT[home + offset] == 0
+        board = np.flatnonzero(candidate)
+        boards.append(board)
+        moves.append(home[board] | (home[board] + 2 * np.sign(rook)) << 6)
+    return np.concatenate(boards), np.concatenate(moves)
+
+
+# Marks the legal moves of each position in an N x 64 x 64 array indexed [position, from, to]
+def legal_move_masks(codes, turn, castling, ep):
+    board, moves = legal_moves(codes, turn, castling, ep)
+    masks = np.zeros((len(codes), 64, 64), bool)
+    masks[board, moves & 63, moves >> 6 & 63] = True
+    return masks
+
+
+# Splits the flat result of legal_moves into one list of packed moves per position
+def move_lists(codes, turn, castling, ep):
+    board, moves = legal_moves(codes, turn, castling, ep)
+    return [list(part) for part in np.split(moves, np.searchsorted(board, np.arange(1, len(codes))))]
+
+
+# Builds the batch arrays from Board objects
+def stack_boards(boards):
+    codes = np.stack([board.codes for board in boards])
+    turn = np.array([WHITE if board.turn == "White" else BLACK for board in boards])
+    castling = np.array([board.castling for board in boards])
+    ep = np.array([-1 if board.en_passant is None else
+                   (board.en_passant.y - board.en_passant.direction) * 8 + board.en_passant.x for board in boards])
+    return codes, turn, castling, ep
+
+
+# Builds the batch arrays from bitboard Positions
+def stack_positions(positions):
+    codes = np.zeros((len(positions), 64), np.int8)
+    for index, position in enumerate(positions):
+        for square, piece in enumerate(position.squares):
+            if piece is not None:
+                codes[index, square] = piece[1] + 1 if piece[0] == WHITE else -piece[1] - 1
+    turn = np.array([position.turn for position in positions])
+    castling = np.array([position.castling for position in positions])
+    ep = np.array([-1 if position.ep is None else position.ep for position in positions])
+    return codes.reshape(-1, 8, 8), turn, castling, ep
+
+
+# Plays random games on bitboard Boards and keeps a copy of every position reached
+def random_boards(count, seed):
+    from classes import Board
+    generator = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = Board(100, 250, backend="bitboard")
+        board.fill_board()
+        for ply in range(120):
+            moves = board.get_moves(board.turn)
+            if not moves or len(boards) >= count:
+                break
+            boards.append(board.copy())
+            piece, target, promotion = generator.choice(moves)
+            board.make_move(piece, *target, promotion)
+    return boards
+
+
+# Times Board.get_moves on each board against one batched pass over all of them, and checks they agree
+def benchmark(count, seed):
+    boards = random_boards(count, seed)
+    start = time.perf_counter()
+    looped = [board.get_moves(board.turn) for board in boards]
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    arrays = stack_boards(boards)
+    stack_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = move_lists(*arrays)
+    batch_time = time.perf_counter() - start
+    names = {"Queen": QUEEN, "Rook": ROOK, "Bishop": BISHOP, "Knight": KNIGHT}
+    for board, moves, batch in zip(boards, looped, batched):
+        expected = sorted(piece.y * 8 + piece.x | (target[1] * 8 + target[0]) << 6
+                          | (names[promotion.__name__] << 12 if promotion else 0) for piece, target, promotion in moves)
+        if expected != sorted(batch):
+            raise AssertionError("Batched moves differ from Board.get_moves:\n%s\n%s" % (expected, sorted(batch)))
+    moves = sum(len(batch) for batch in batched)
+    print("%d positions, %d moves" % (count, moves))
+    print("Board.get_moves  %8.3fs %10.0f positions/s" % (loop_time, count / loop_time))
+    print("batched          %8.3fs %10.0f positions/s (%.3fs more to stack the boards)  %.1fx"
+          % (batch_time, count / batch_time, stack_time, loop_time / batch_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares batched move generation with Board.get_moves on random positions")
+    parser.add_argument("positions", nargs="?", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    benchmark(args.positions, args.seed)
@@ -0,0 +1,567 @@
+import numpy as np
+
+# Squares are numbered y * 8 + x using the same coordinates as Board, so square 0 is
+# black's queen side corner and white's pieces start on squares 48-63.
+WHITE = 0
+BLACK = 1
+COLORS = ("White", "Black")
+
+PAWN = 0
+KNIGHT = 1
+BISHOP = 2
+ROOK = 3
+QUEEN = 4
+KING = 5
+NAMES = ("Pawn", "Knight", "Bishop", "Rook", "Queen", "King")
+KINDS = {name: kind for kind, name in enumerate(NAMES)}
+
+# Shared (color, kind) tuples stored in Position.squares
+PIECES = (tuple((WHITE, kind) for kind in range(6)), tuple((BLACK, kind) for kind in range(6)))
+
+FULL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+ROWS = tuple(0xFF << (8 * y) for y in range(8))
+
+# Castling rights bits
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+
+ROOK_DIRECTIONS = ((0, -1), (1, 0), (0, 1), (-1, 0))
+BISHOP_DIRECTIONS = ((1, -1), (1, 1), (-1, 1), (-1, -1))
+KNIGHT_OFFSETS = ((1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1), (-1, -2))
+KING_OFFSETS = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+
+
+def _offset_table(offsets):
+    table = []
+    for sq in range(64):
+        x = sq & 7
+        y = sq >> 3
+        mask = 0
+        for dx, dy in offsets:
+            if 0 <= x + dx < 8 and 0 <= y + dy < 8:
+                mask |= 1 << ((y + dy) * 8 + x + dx)
+        table.append(mask)
+    return tuple(table)
+
+
+# Walks the rays from a square, stopping on (and including) the first occupied square
+def _slide(sq, occupied, directions):
+    attacks = 0
+    for dx, dy in directions:
+        x = (sq & 7) + dx
+        y = (sq >> 3) + dy
+        while 0 <= x < 8 and 0 <= y < 8:
+            bit = 1 << (y * 8 + x)
+            attacks |= bit
+            if occupied & bit:
+                break
+            x += dx
+            y += dy
+    return attacks
+
+
+# The squares on a square's rays whose occupancy matters, i.e. without the board edge at the end of each ray
+def _relevant_mask(sq, directions):
+    mask = 0
+    for dx, dy in directions:
+        x = (sq & 7) + dx
+        y = (sq >> 3) + dy
+        while 0 <= x + dx < 8 and 0 <= y + dy < 8:
+            mask |= 1 << (y * 8 + x)
+            x += dx
+            y += dy
+    return mask
+
+
+KNIGHT_ATTACKS = _offset_table(KNIGHT_OFFSETS)
+KING_ATTACKS = _offset_table(KING_OFFSETS)
+# Squares attacked by a pawn of each color standing on a square
+PAWN_ATTACKS = (_offset_table(((-1, -1), (1, -1))), _offset_table(((-1, 1), (1, 1))))
+ROOK_MASKS = tuple(_relevant_mask(sq, ROOK_DIRECTIONS) for sq in range(64))
+BISHOP_MASKS = tuple(_relevant_mask(sq, BISHOP_DIRECTIONS) for sq in range(64))
+# Sliding attacks keyed by the relevant occupancy, filled in the first time each pattern is seen
+ROOK_TABLES = tuple({} for sq in range(64))
+BISHOP_TABLES = tuple({} for sq in range(64))
+
+# Every square on the line through two aligned squares, or 0 if they are not aligned.
+# BETWEEN[a][b] holds the squares strictly between them and BEYOND[a][b] the squares past b
+# seen from a, both 0 for squares that are not aligned
+LINES = [[0] * 64 for sq in range(64)]
+BETWEEN = [[0] * 64 for sq in range(64)]
+BEYOND = [[0] * 64 for sq in range(64)]
+for _sq in range(64):
+    for _dx, _dy in KING_OFFSETS:
+        _ahead = _slide(_sq, 0, ((_dx, _dy),))
+        _ray = _ahead | _slide(_sq, 0, ((-_dx, -_dy),)) | (1 << _sq)
+        _between = 0
+        _x = (_sq & 7) + _dx
+        _y = (_sq >> 3) + _dy
+        while 0 <= _x < 8 and 0 <= _y < 8:
+            _bit = 1 << (_y * 8 + _x)
+            LINES[_sq][_y * 8 + _x] = _ray
+            BETWEEN[_sq][_y * 8 + _x] = _between
+            BEYOND[_sq][_y * 8 + _x] = _ahead & ~_between & ~_bit
+            _between |= _bit
+            _x += _dx
+            _y += _dy
+
+# Rights kept after a move touches a square
+CASTLE_MASKS = [15] * 64
+CASTLE_MASKS[60] = 15 & ~(WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+CASTLE_MASKS[63] = 15 & ~WHITE_KING_SIDE
+CASTLE_MASKS[56] = 15 & ~WHITE_QUEEN_SIDE
+CASTLE_MASKS[4] = 15 & ~(BLACK_KING_SIDE | BLACK_QUEEN_SIDE)
+CASTLE_MASKS[7] = 15 & ~BLACK_KING_SIDE
+CASTLE_MASKS[0] = 15 & ~BLACK_QUEEN_SIDE
+
+
+def rook_attacks(sq, occupied):
+    key = occupied & ROOK_MASKS[sq]
+    table = ROOK_TABLES[sq]
+    attacks = table.get(key)
+    if attacks is None:
+        attacks = table[key] = _slide(sq, key, ROOK_DIRECTIONS)
+    return attacks
+
+
+def bishop_attacks(sq, occupied):
+    key = occupied & BISHOP_MASKS[sq]
+    table = BISHOP_TABLES[sq]
+    attacks = table.get(key)
+    if attacks is None:
+        attacks = table[key] = _slide(sq, key, BISHOP_DIRECTIONS)
+    return attacks
+
+
+# Yields the index of every set bit
+def squares_of(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+# Moves are packed into ints: from square | to square << 6 | promotion kind << 12
+def encode_move(frm, to, promotion=0):
+    return frm | (to << 6) | (promotion << 12)
+
+
+class Position:
+    def __init__(self):
+        self.pieces = [[0] * 6, [0] * 6]
+        self.occupied = [0, 0]
+        self.squares = [None] * 64
+        self.turn = WHITE
+        self.castling = 0
+        self.ep = None # Square a pawn can capture onto en passant
+        self.halfmove = 0
+        self.fullmove = 1
+
+    # Returns a position with the standard starting setup
+    @classmethod
+    def initial(cls):
+        position = cls()
+        order = (ROOK, KNIGHT, BISHOP, QUEEN, KING, BISHOP, KNIGHT, ROOK)
+        for x in range(8):
+            position.put(x, BLACK, order[x])
+            position.put(8 + x, BLACK, PAWN)
+            position.put(48 + x, WHITE, PAWN)
+            position.put(56 + x, WHITE, order[x])
+        position.castling = 15
+        return position
+
+    # Builds a position from the pieces on a Board
+    @classmethod
+    def from_board(cls, board, turn=WHITE):
+        position = cls()
+        for y in range(8):
+            for x in range(8):
+                piece = board.get_space(x, y)
+                if piece is not None:
+                    position.put(y * 8 + x, COLORS.index(piece.color), KINDS[piece.name])
+        position.castling = castling_rights(board)
+        if board.en_passant is not None:
+            position.ep = (board.en_passant.y - board.en_passant.direction) * 8 + board.en_passant.x
+        position.turn = turn
+        return position
+
+    def copy(self):
+        position = Position()
+        position.pieces = [self.pieces[WHITE][:], self.pieces[BLACK][:]]
+        position.occupied = self.occupied[:]
+        position.squares = self.squares[:]
+        position.turn = self.turn
+        position.castling = self.castling
+        position.ep = self.ep
+        position.halfmove = self.halfmove
+        position.fullmove = self.fullmove
+        return position
+
+    # Places a piece, replacing anything already on the square
+    def put(self, sq, color, kind):
+        self.remove(sq)
+        bit = 1 << sq
+        self.pieces[color][kind] |= bit
+        self.occupied[color] |= bit
+        self.squares[sq] = PIECES[color][kind]
+
+    # Clears a square, does nothing if it is empty
+    def remove(self, sq):
+        piece = self.squares[sq]
+        if piece is None:
+            return
+        bit = 1 << sq
+        self.pieces[piece[0]][piece[1]] ^= bit
+        self.occupied[piece[0]] ^= bit
+        self.squares[sq] = None
+
+    def king_square(self, color):
+        king = self.pieces[color][KING]
+        return king.bit_length() - 1 if king else None
+
+    # Returns a mask of the pieces of the given color attacking a square
+    def attackers(self, sq, color, occupied=None):
+        if occupied is None:
+            occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        pieces = self.pieces[color]
+        return (PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWN]) \
+            | (KNIGHT_ATTACKS[sq] & pieces[KNIGHT]) \
+            | (KING_ATTACKS[sq] & pieces[KING]) \
+            | (rook_attacks(sq, occupied) & (pieces[ROOK] | pieces[QUEEN])) \
+            | (bishop_attacks(sq, occupied) & (pieces[BISHOP] | pieces[QUEEN]))
+
+    def is_attacked(self, sq, color):
+        return self.attackers(sq, color) != 0
+
+    # Returns a mask of every square the given color attacks
+    def attacked_squares(self, color):
+        occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        pieces = self.pieces[color]
+        attacks = 0
+        for sq in squares_of(pieces[PAWN]):
+            attacks |= PAWN_ATTACKS[color][sq]
+        for sq in squares_of(pieces[KNIGHT]):
+            attacks |= KNIGHT_ATTACKS[sq]
+        for sq in squares_of(pieces[BISHOP] | pieces[QUEEN]):
+            attacks |= bishop_attacks(sq, occupied)
+        for sq in squares_of(pieces[ROOK] | pieces[QUEEN]):
+            attacks |= rook_attacks(sq, occupied)
+        for sq in squares_of(pieces[KING]):
+            attacks |= KING_ATTACKS[sq]
+        return attacks
+
+    def in_check(self, color=None):
+        if color is None:
+            color = self.turn
+        king = self.king_square(color)
+        return king is not None and self.is_attacked(king, color ^ 1)
+
+    # Appends every pseudo legal move for a color to moves
+    def pseudo_legal_moves(self, color, moves):
+        pieces = self.pieces[color]
+        own = self.occupied[color]
+        enemy = self.occupied[color ^ 1]
+        occupied = own | enemy
+        empty = ~occupied & FULL
+
+        # Pawns are generated a whole set at a time by shifting the pawn board
+        pawns = pieces[PAWN]
+        if color == WHITE:
+            single = (pawns >> 8) & empty
+            double = ((single & ROWS[5]) >> 8) & empty
+            left = ((pawns & ~FILE_A) >> 9)
+            right = ((pawns & ~FILE_H) >> 7)
+            pushes = ((single, 8), (double, 16))
+            captures = ((left, 9), (right, 7))
+            last_row = ROWS[0]
+        else:
+            single = (pawns << 8) & empty
+            double = ((single & ROWS[2]) << 8) & empty
+            left = ((pawns & ~FILE_A) << 7) & FULL
+            right = ((pawns & ~FILE_H) << 9) & FULL
+            pushes = ((single, -8), (double, -16))
+            captures = ((left, -7), (right, -9))
+            last_row = ROWS[7]
+        targets = enemy
+        if self.ep is not None and color == self.turn:
+            targets |= 1 << self.ep
+        for mask, back in pushes + tuple((mask & targets, back) for mask, back in captures):
+            for to in squares_of(mask & ~last_row):
+                moves.append((to + back) | (to << 6))
+            for to in squares_of(mask & last_row):
+                frm = (to + back) | (to << 6)
+                moves.append(frm | (QUEEN << 12))
+                moves.append(frm | (ROOK << 12))
+                moves.append(frm | (BISHOP << 12))
+                moves.append(frm | (KNIGHT << 12))
+
+        not_own = ~own
+        for frm in squares_of(pieces[KNIGHT]):
+            for to in squares_of(KNIGHT_ATTACKS[frm] & not_own):
+                moves.append(frm | (to << 6))
+        for frm in squares_of(pieces[BISHOP]):
+            for to in squares_of(bishop_attacks(frm, occupied) & not_own):
+                moves.append(frm | (to << 6))
+        for frm in squares_of(pieces[ROOK]):
+            for to in squares_of(rook_attacks(frm, occupied) & not_own):
+                moves.append(frm | (to << 6))
+        for frm in squares_of(pieces[QUEEN]):
+            for to in squares_of((rook_attacks(frm, occupied) | bishop_attacks(frm, occupied)) & not_own):
+                moves.append(frm | (to << 6))
+        for frm in squares_of(pieces[KING]):
+            for to in squares_of(KING_ATTACKS[frm] & not_own):
+                moves.append(frm | (to << 6))
+            self._castling_moves(color, frm, occupied, moves)
+        return moves
+
+    def _castling_moves(self, color, king, occupied, moves):
+        if color == WHITE:
+            rights = self.castling & (WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+            king_side = WHITE_KING_SIDE
+            home = 60
+        else:
+            rights = self.castling >> 2 & (WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+            king_side = WHITE_KING_SIDE
+            home = 4
+        if not rights or king != home:
+            return
+        enemy = color ^ 1
+        rooks = self.pieces[color][ROOK]
+        if rights & king_side and rooks >> (home + 3) & 1 and not occupied & (0b11 << (home + 1)) \
+                and not self.is_attacked(home, enemy) and not self.is_attacked(home + 1, enemy) \
+                and not self.is_attacked(home + 2, enemy):
+            moves.append(home | ((home + 2) << 6))
+        if rights & (king_side << 1) and rooks >> (home - 4) & 1 and not occupied & (0b111 << (home - 3)) \
+                and not self.is_attacked(home, enemy) and not self.is_attacked(home - 1, enemy) \
+                and not self.is_attacked(home - 2, enemy):
+            moves.append(home | ((home - 2) << 6))
+
+    # Returns the legal moves for a color, the side to move by default
+    def legal_moves(self, color=None):
+        if color is None:
+            color = self.turn
+        moves = self.pseudo_legal_moves(color, [])
+        king = self.king_square(color)
+        if king is None:
+            return moves
+        enemy = color ^ 1
+        checked = self.is_attacked(king, enemy)
+        lines = LINES[king]
+        legal = []
+        for move in moves:
+            frm = move & 63
+            # Off the king's lines a non king move can only matter when in check or capturing en passant
+            if checked or frm == king or lines[frm] or ((move >> 6) & 63) == self.ep:
+                if not self._is_safe(move, color, king):
+                    continue
+            legal.append(move)
+        return legal
+
+    # Checks the mover's king is not attacked once the move is made, without making it
+    def _is_safe(self, move, color, king):
+        frm = move & 63
+        to = (move >> 6) & 63
+        enemy = color ^ 1
+        pieces = self.pieces[enemy]
+        occupied = (self.occupied[WHITE] | self.occupied[BLACK]) & ~(1 << frm) | (1 << to)
+        removed = 1 << to
+        if frm == king:
+            king = to
+        elif to == self.ep and self.squares[frm][1] == PAWN:
+            captured = to + 8 if color == WHITE else to - 8
+            removed |= 1 << captured
+            occupied &= ~(1 << captured)
+        keep = ~removed
+        return not ((PAWN_ATTACKS[color][king] & pieces[PAWN] & keep)
+                    or (KNIGHT_ATTACKS[king] & pieces[KNIGHT] & keep)
+                    or (KING_ATTACKS[king] & pieces[KING])
+                    or (rook_attacks(king, occupied) & (pieces[ROOK] | pieces[QUEEN]) & keep)
+                    or (bishop_attacks(king, occupied) & (pieces[BISHOP] | pieces[QUEEN]) & keep))
+
+    # Plays a move and returns the record unmake_move needs to take it back.
+    # A pawn reaching the last row without a promotion kind is taken off the board,
+    # matching how Board waits for the promoted piece to be added
+    def make_move(self, move):
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = move >> 12
+        color, kind = self.squares[frm]
+        captured = self.squares[to]
+        undo = (move, color, kind, captured, self.castling, self.ep, self.halfmove, self.fullmove, self.turn)
+        if captured is not None:
+            self.remove(to)
+        self.remove(frm)
+        if kind == PAWN and to == self.ep:
+            self.remove(to + 8 if color == WHITE else to - 8)
+        if kind == PAWN and (to < 8 or to >= 56):
+            if promotion:
+                self.put(to, color, promotion)
+        else:
+            self.put(to, color, kind)
+        if kind == KING and (to - frm == 2 or frm - to == 2):
+            if to > frm:
+                self.remove(frm + 3)
+                self.put(frm + 1, color, ROOK)
+            else:
+                self.remove(frm - 4)
+                self.put(frm - 1, color, ROOK)
+        if kind == PAWN and (to - frm == 16 or frm - to == 16):
+            self.ep = (frm + to) >> 1
+        else:
+            self.ep = None
+        self.castling &= CASTLE_MASKS[frm] & CASTLE_MASKS[to]
+        if kind == PAWN or captured is not None:
+            self.halfmove = 0
+        else:
+            self.halfmove += 1
+        if color == BLACK:
+            self.fullmove += 1
+        self.turn = color ^ 1
+        return undo
+
+    def unmake_move(self, undo):
+        move, color, kind, captured, castling, ep, halfmove, fullmove, turn = undo
+        frm = move & 63
+        to = (move >> 6) & 63
+        self.remove(to)
+        self.put(frm, color, kind)
+        if captured is not None:
+            self.put(to, *captured)
+        if kind == PAWN and to == ep:
+            self.put(to + 8 if color == WHITE else to - 8, color ^ 1, PAWN)
+        if kind == KING and (to - frm == 2 or frm - to == 2):
+            if to > frm:
+                self.remove(frm + 1)
+                self.put(frm + 3, color, ROOK)
+            else:
+                self.remove(frm - 1)
+                self.put(frm - 4, color, ROOK)
+        self.castling = castling
+        self.ep = ep
+        self.halfmove = halfmove
+        self.fullmove = fullmove
+        self.turn = turn
+
+
+# Derives castling rights from the King.moved and Rook.moved flags of a Board
+def castling_rights(board):
+    rights = 0
+    for color, y, king_side in (("White", 7, WHITE_KING_SIDE), ("Black", 0, BLACK_KING_SIDE)):
+        king = board.get_space(4, y)
+        if king is None or king.name != "King" or king.color != color or king.moved:
+            continue
+        for x, right in ((7, king_side), (0, king_side << 1)):
+            rook = board.get_space(x, y)
+            if rook is not None and rook.name == "Rook" and rook.color == color and not rook.moved:
+                rights |= right
+    return rights
+
+
+# Converts a mask into the 8x8 0/1 layout of Board.white_spaces
+def mask_to_spaces(mask):
+    return ((np.uint64(mask) >> np.arange(64, dtype=np.uint64)) & np.uint64(1)).astype(float).reshape(8, 8)
+
+
+# Move generation backend for Board built on a Position kept in step with the pieces.
+# Piece.get_valid_moves and Piece.move hand over to it when the Board is created with
+# backend="bitboard"; the moves it returns follow the full rules, including pins
+class BitboardBackend:
+    def __init__(self, board):
+        self.board = board
+        self.position = Position()
+        self.moves = None # Legal moves per color, cleared whenever the position changes
+        self.targets = None # Per color, the target squares of the legal moves by from square, cleared with moves
+
+    # Takes the castling rights the Board worked out for the new piece
+    def add_piece(self, piece, castling):
+        self.position.put(piece.y * 8 + piece.x, COLORS.index(piece.color), KINDS[piece.name])
+        self.position.castling = castling
+        self.moves = None
+        self.targets = None
+
+    def remove_piece(self, x, y):
+        self.position.remove(y * 8 + x)
+        self.position.castling &= CASTLE_MASKS[y * 8 + x]
+        self.moves = None
+        self.targets = None
+
+    # Returns the position state Board.make_move records besides the squares it touches
+    def state(self):
+        position = self.position
+        return position.castling, position.ep, position.halfmove, position.fullmove, position.turn
+
+    # Puts the squares of an undone move back and restores the recorded state
+    def restore(self, occupants, state):
+        position = self.position
+        for x, y, piece in occupants:
+            if piece is None:
+                position.remove(y * 8 + x)
+            else:
+                position.put(y * 8 + x, COLORS.index(piece.color), KINDS[piece.name])
+        position.castling, position.ep, position.halfmove, position.fullmove, position.turn = state
+        self.moves = None
+        self.targets = None
+
+    def legal_moves(self, color):
+        if self.moves is None:
+            self.moves = {}
+        moves = self.moves.get(color)
+        if moves is None:
+            moves = self.moves[color] = self.position.legal_moves(color)
+        return moves
+
+    def in_check(self, color):
+        position = self.position
+        color = COLORS.index(color)
+        king = position.king_square(color)
+        return king is not None and position.attackers(king, color ^ 1) != 0
+
+    # Returns the squares a piece can legally move to
+    def get_valid_moves(self, piece):
+        color = COLORS.index(piece.color)
+        if self.targets is None:
+            self.targets = {}
+        targets = self.targets.get(color)
+        if targets is None:
+            # Sort the legal moves by from square once, rather than scanning them for every piece
+            targets = self.targets[color] = {}
+            for move in self.legal_moves(color):
+                to = (move >> 6) & 63
+                spaces = targets.setdefault(move & 63, [])
+                if (to & 7, to >> 3) not in spaces:
+                    spaces.append((to & 7, to >> 3))
+        return list(targets.get(piece.y * 8 + piece.x, ()))
+
+    # Returns the 8x8 attack map of a color, for Board.white_spaces and Board.black_spaces
+    def spaces(self, color):
+        return mask_to_spaces(self.position.attacked_squares(color))
+
+    # Mirrors a move Piece.move just made on the Board and returns its move value
+    def move(self, piece, old_x, old_y, other_piece, promotion):
+        board = self.board
+        position = self.position
+        position.make_move(encode_move(old_y * 8 + old_x, piece.y * 8 + piece.x))
+        position.halfmove = board.halfmove # The capture was taken off the position before the move
+        self.moves = None
+        self.targets = None
+        if promotion:
+            # The pawn leaves the board until the promoted piece is added
+            board.remove_piece(piece)
+        color = position.turn
+        board.white_spaces = None # Worked out if they are read, see Board.white_spaces
+        board.black_spaces = None
+        king = position.king_square(color)
+        checkers = position.attackers(king, color ^ 1) if king is not None else 0
+        if checkers:
+            board.check = True
+            checker = checkers.bit_length() - 1
+            board.attacking_piece = board.get_space(checker & 7, checker >> 3)
+            if not self.legal_moves(color):
+                return [2, piece.color]
+        if other_piece is not None:
+            return [1, other_piece]
+        return [0]
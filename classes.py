@@ -1,29 +1,131 @@
 from abc import ABC, abstractmethod
 import numpy as np
-import pygame
+from attacks import AttackMap, NullAttackMap, VectorAttackMap, piece_code
+from bitboard import (BitboardBackend, CASTLE_MASKS, castling_rights, squares_of, WHITE, BLACK, FULL, LINES, BETWEEN,
+                      BEYOND, KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, rook_attacks, bishop_attacks)
+import zobrist
+
+# FEN letter of each piece, white pieces are written in upper case
+FEN_LETTERS = {"Pawn": "p", "Knight": "n", "Bishop": "b", "Rook": "r", "Queen": "q", "King": "k"}
+# FEN castling letters and their castling rights bits, see bitboard.castling_rights
+FEN_CASTLING = (("K", 1), ("Q", 2), ("k", 4), ("q", 8))
+# The square of the rook each castling letter needs unmoved
+FEN_ROOKS = {"K": (7, 7), "Q": (0, 7), "k": (7, 0), "q": (0, 0)}
+
+
+# The pieces of one color in the order they were added. Each piece keeps its slot, so removing a
+# piece or putting it back where it was is O(1), and the pieces are also kept in a set per type
+class PieceList:
+    def __init__(self):
+        self.slots = [] # Pieces by slot, None where a piece was removed
+        self.slot = {} # Piece -> slot
+        self.types = {} # Piece name -> pieces of that type, a dict used as an ordered set
+
+    def __iter__(self):
+        return (piece for piece in self.slots if piece is not None)
+
+    def __len__(self):
+        return len(self.slot)
+
+    def __contains__(self, piece):
+        return piece in self.slot
+
+    # Returns the slot of a piece, so sorting by it follows the order the pieces were added
+    def index(self, piece):
+        return self.slot[piece]
+
+    # Returns the pieces of one type, e.g. "Pawn"
+    def of_type(self, name):
+        return self.types.get(name, {}).keys()
+
+    def append(self, piece):
+        self.insert(len(self.slots), piece)
+
+    # Puts a piece into a slot, as remove left it
+    def insert(self, i, piece):
+        if i >= len(self.slots):
+            self.slots += [None] * (i + 1 - len(self.slots))
+        self.slots[i] = piece
+        self.slot[piece] = i
+        self.types.setdefault(piece.name, {})[piece] = None
+
+    # Takes a piece out and returns its slot, or None if it was not in the list
+    def remove(self, piece):
+        i = self.slot.pop(piece, None)
+        if i is None:
+            return None
+        self.slots[i] = None
+        del self.types[piece.name][piece]
+        while self.slots and self.slots[-1] is None:
+            self.slots.pop()
+        return i
 
 
 class Board:
-    def __init__(self, square_size, sidebar):
+    piece_list = PieceList # Holds each color's pieces, replay.py swaps in a plain list to compare
+
+    def __init__(self, square_size, sidebar, debug=False, backend="objects", attack_maps="incremental"):
         self.square_size = square_size
         self.sidebar = sidebar
         self.board = np.empty((8, 8), Piece)
+        self.codes = np.zeros((8, 8), np.int8) # The board as piece codes, see attacks.piece_code
+        self.occupied = 0 # Bit y * 8 + x set for every occupied square
         self.shape = self.board.shape
-        self.white_pieces = []
-        self.black_pieces = []
+        self.white_pieces = self.piece_list()
+        self.black_pieces = self.piece_list()
         self.white_king = None
         self.black_king = None
-        self.white_spaces = np.zeros((8, 8))
-        self.black_spaces = np.zeros((8, 8))
+        # Attack maps, see the white_spaces and black_spaces properties
+        self._white_spaces = np.zeros((8, 8))
+        self._black_spaces = np.zeros((8, 8))
         self.en_passant = None
         self.en_passant_counter = 0
+        self.halfmove = 0 # Moves since the last capture or pawn move
+        self.fullmove = 1 # Starts at 1 and goes up after each black move
         self.check = False
         self.attacking_piece = None
-        self.check_other_moves = []
+        self.check_squares = 0 # While in check, the squares a piece other than the king may move to
+        # attack_maps="vectorized" recomputes the maps with NumPy after each move instead of updating them
+        self.attack_maps = attack_maps
+        # backend="bitboard" hands move generation over to a bitboard position kept in step with the pieces
+        if backend == "bitboard":
+            self.attacks = NullAttackMap(self, debug)
+            self.bitboard = BitboardBackend(self)
+        else:
+            self.attacks = (VectorAttackMap if attack_maps == "vectorized" else AttackMap)(self, debug) # Set debug to cross-check the attack maps
+            self.bitboard = None
+        self.undo_stack = [] # Undo records pushed by make_move
+        self.journal = None # Pieces taken out of the piece lists while make_move is recording
+        self.turn = "White"
+        self.castling = 0 # Castling rights bits, see bitboard.castling_rights
+        # Zobrist hash of the squares, castling rights, en passant file and side to move, kept up to date as pieces change
+        self.hash = zobrist.CASTLING_KEYS[0]
 
     def __str__(self):
         return str(self.board)
 
+    # Squares each color attacks or defends as 8x8 arrays, 0 where it does not. The bitboard backend
+    # sets them to None after a move and they are worked out from its position when next read
+    @property
+    def white_spaces(self):
+        if self._white_spaces is None:
+            self._white_spaces = self.bitboard.spaces(WHITE)
+        return self._white_spaces
+
+    @white_spaces.setter
+    def white_spaces(self, spaces):
+        self._white_spaces = spaces
+
+    @property
+    def black_spaces(self):
+        if self._black_spaces is None:
+            self._black_spaces = self.bitboard.spaces(BLACK)
+        return self._black_spaces
+
+    @black_spaces.setter
+    def black_spaces(self, spaces):
+        self._black_spaces = spaces
+
     def flip(self, x, y):
         return 7 - x, 7 - y
 
@@ -31,9 +133,46 @@ class Board:
     def get_space(self, x, y):
         return self.board[y][x]
 
+    # Sets the contents of the specified space, keeping the hash and attack maps in step
+    def set_space(self, x, y, piece):
+        old = self.board[y][x]
+        if old is not None:
+            self.hash ^= zobrist.piece_key(old, x, y)
+        if piece is not None:
+            self.hash ^= zobrist.piece_key(piece, x, y)
+        self.board[y][x] = piece
+        self.codes[y][x] = piece_code(piece)
+        if piece is None:
+            self.occupied &= ~(1 << (y * 8 + x))
+        else:
+            self.occupied |= 1 << (y * 8 + x)
+        self.attacks.touch(x, y)
+
+    def set_castling(self, castling):
+        self.hash ^= zobrist.CASTLING_KEYS[self.castling] ^ zobrist.CASTLING_KEYS[castling]
+        self.castling = castling
+
+    # Sets the pawn that can be captured en passant, or None
+    def set_en_passant(self, pawn):
+        if self.en_passant is not None:
+            self.hash ^= zobrist.EN_PASSANT_KEYS[self.en_passant.x]
+        if pawn is not None:
+            self.hash ^= zobrist.EN_PASSANT_KEYS[pawn.x]
+        self.en_passant = pawn
+
+    def set_turn(self, turn):
+        if turn != self.turn:
+            self.hash ^= zobrist.BLACK_TO_MOVE
+            self.turn = turn
+
     # Adds a piece to the board
     def add_piece(self, piece):
-        self.board[piece.y][piece.x] = piece
+        replaced = self.board[piece.y][piece.x]
+        if replaced is not None:
+            # The piece it takes the place of leaves the piece lists and attack maps too
+            self.remove_piece(replaced)
+        self.set_space(piece.x, piece.y, piece)
+        self.attacks.invalidate(piece)
         if piece.color == "White":
             self.white_pieces.append(piece)
             if piece.name == "King":
@@ -42,18 +181,245 @@ class Board:
             self.black_pieces.append(piece)
             if piece.name == "King":
                 self.black_king = piece
+        # Only a king or rook arriving can change the castling rights, remove_piece saw to the replaced piece.
+        # The bitboard position takes the rights from here rather than working them out again
+        if piece.name == "King" or piece.name == "Rook":
+            self.set_castling(castling_rights(self))
+        if self.bitboard is not None:
+            self.bitboard.add_piece(piece, self.castling)
 
     # Removes a piece from the board
     def remove_piece(self, piece):
-        self.board[piece.y][piece.x] = None
+        self.set_space(piece.x, piece.y, None)
+        if self.bitboard is not None:
+            self.bitboard.remove_piece(piece.x, piece.y)
         if piece.color == "White":
             pieces = self.white_pieces
         else:
             pieces = self.black_pieces
-        for i in range(len(pieces)):
-            if pieces[i].x == piece.x and pieces[i].y == piece.y:
-                pieces.pop(i)
-                break
+        i = pieces.remove(piece)
+        if i is not None:
+            self.attacks.discard(piece)
+            if self.journal is not None:
+                self.journal.append((pieces, i, piece))
+        if piece.name == "King" or piece.name == "Rook":
+            self.set_castling(castling_rights(self))
+
+    # Moves a piece like Piece.move, but pushes an undo record so unmake_move can take it back.
+    # A promotion is finished with the given piece class, e.g. Queen, instead of waiting for add_piece
+    def make_move(self, piece, new_x, new_y, promotion=None):
+        # Every square the move can change: origin, target, en passant victim and castling rook squares
+        squares = [(piece.x, piece.y), (new_x, new_y)]
+        if piece.name == "Pawn" and new_x != piece.x:
+            squares.append((new_x, piece.y))
+        elif piece.name == "King" and not piece.moved:
+            squares += [(0, piece.y), (3, piece.y), (5, piece.y), (7, piece.y)]
+        occupants = tuple((x, y, self.board[y][x]) for x, y in squares)
+        states = [(occupant, occupant.x, occupant.y, getattr(occupant, "moved", None), getattr(occupant, "en_passant", None))
+                  for x, y, occupant in occupants if occupant is not None]
+        if self.en_passant is not None:
+            states.append((self.en_passant, self.en_passant.x, self.en_passant.y, self.en_passant.moved, self.en_passant.en_passant))
+        status = (self.en_passant, self.en_passant_counter, self.check, self.attacking_piece, self.check_squares,
+                 self._white_spaces, self._black_spaces, self.turn, self.castling, self.hash, self.halfmove, self.fullmove)
+        bitboard = self.bitboard.state() if self.bitboard is not None else None
+        journal = self.journal
+        self.journal = []
+        promoted = None
+        try:
+            value = piece.move(self, new_x, new_y)
+            if value[0] == 3 and promotion is not None:
+                promoted = promotion(value[2], value[3], value[4])
+                self.add_piece(promoted)
+                if self.bitboard is None:
+                    self.attacks.update()
+                    if self.check:
+                        self.get_check_moves(None) # The promoted piece gives check
+        finally:
+            journal, self.journal = self.journal, journal
+        record = (occupants, states, journal, promoted, status, bitboard)
+        self.undo_stack.append(record)
+        return value
+
+    # Takes back the last move played with make_move
+    def unmake_move(self):
+        occupants, states, journal, promoted, status, bitboard = self.undo_stack.pop()
+        self.en_passant, self.en_passant_counter, self.check, self.attacking_piece, self.check_squares, \
+            self._white_spaces, self._black_spaces, self.turn, self.castling, self.hash, self.halfmove, self.fullmove = status
+        if promoted is not None:
+            pieces = self.white_pieces if promoted.color == "White" else self.black_pieces
+            pieces.remove(promoted)
+            self.attacks.discard(promoted)
+        for pieces, i, removed in reversed(journal):
+            pieces.insert(i, removed)
+            self.attacks.invalidate(removed)
+        for x, y, occupant in occupants:
+            self.board[y][x] = occupant
+            self.codes[y][x] = piece_code(occupant)
+            if occupant is None:
+                self.occupied &= ~(1 << (y * 8 + x))
+            else:
+                self.occupied |= 1 << (y * 8 + x)
+            self.attacks.touch(x, y)
+        for piece, x, y, moved, en_passant in states:
+            piece.x = x
+            piece.y = y
+            if moved is not None:
+                piece.moved = moved
+            if en_passant is not None:
+                piece.en_passant = en_passant
+            self.attacks.invalidate(piece)
+        if bitboard is not None:
+            self.bitboard.restore(occupants, bitboard)
+
+    # Lists (piece, (x, y), promotion) for every move a color can make. Moves onto the last row are
+    # listed once per promotion piece class
+    def get_moves(self, color, promotions=None):
+        if promotions is None:
+            promotions = (Queen, Rook, Bishop, Knight)
+        moves = []
+        for piece in self.white_pieces if color == "White" else self.black_pieces:
+            for target in piece.get_valid_moves(self):
+                if piece.name == "Pawn" and (target[1] == 0 or target[1] == 7):
+                    for promotion in promotions:
+                        moves.append((piece, target, promotion))
+                else:
+                    moves.append((piece, target, None))
+        return moves
+
+    # Returns the winning color once the side to move has no moves left, "Draw" for a stalemate,
+    # or None while the game goes on
+    def result(self):
+        if self.get_moves(self.turn):
+            return None
+        if self.bitboard is not None:
+            check = self.bitboard.in_check(self.turn)
+        else:
+            check = self.check and self.attacking_piece is not None and self.attacking_piece.color != self.turn
+        if check:
+            return "Black" if self.turn == "White" else "White"
+        return "Draw"
+
+    # Returns an independent copy of the board with its own pieces, for example for a search to play moves on
+    def copy(self, backend=None):
+        if backend is None:
+            backend = "objects" if self.bitboard is None else "bitboard"
+        board = Board(self.square_size, self.sidebar, self.attacks.debug, backend, self.attack_maps)
+        for piece in [*self.white_pieces, *self.black_pieces]:
+            clone = type(piece)(piece.color, piece.x, piece.y)
+            if hasattr(piece, "moved"):
+                clone.moved = piece.moved
+            if hasattr(piece, "en_passant"):
+                clone.en_passant = piece.en_passant
+            board.add_piece(clone)
+        if self.en_passant is not None:
+            board.set_en_passant(board.get_space(self.en_passant.x, self.en_passant.y))
+        board.en_passant_counter = self.en_passant_counter
+        board.halfmove = self.halfmove
+        board.fullmove = self.fullmove
+        board.set_turn(self.turn)
+        board.set_castling(self.castling)
+        board.white_spaces = self.white_spaces.copy()
+        board.black_spaces = self.black_spaces.copy()
+        board.check = self.check
+        if self.attacking_piece is not None:
+            board.attacking_piece = board.get_space(self.attacking_piece.x, self.attacking_piece.y)
+        board.check_squares = self.check_squares
+        if self.bitboard is not None and board.bitboard is not None:
+            board.bitboard.restore((), self.bitboard.state())
+        elif board.bitboard is not None:
+            position = board.bitboard.position
+            position.turn = WHITE if self.turn == "White" else BLACK
+            if self.en_passant is not None:
+                position.ep = (self.en_passant.y - self.en_passant.direction) * 8 + self.en_passant.x
+        return board
+
+    # Builds a board from a FEN string. The moved flags are worked out from the castling field and
+    # the pawns' starting rows, and the attack maps are computed for the side to move
+    @classmethod
+    def from_fen(cls, fen, square_size=100, sidebar=250, backend="objects", attack_maps="incremental"):
+        fields = fen.split()
+        if len(fields) == 4:
+            fields += ["0", "1"]
+        if len(fields) != 6:
+            raise ValueError("A FEN string has 6 fields, got %r" % fen)
+        placement, side, castling, en_passant, halfmove, fullmove = fields
+        rows = placement.split("/")
+        if len(rows) != 8 or side not in ("w", "b"):
+            raise ValueError("Bad FEN placement or side to move in %r" % fen)
+        board = cls(square_size, sidebar, backend=backend, attack_maps=attack_maps)
+        unmoved = {FEN_ROOKS[char] for char in castling if char in FEN_ROOKS}
+        for y, row in enumerate(rows):
+            x = 0
+            for char in row:
+                if char.isdigit():
+                    x += int(char)
+                    continue
+                piece_class = FEN_CLASSES.get(char.lower())
+                if piece_class is None or x > 7:
+                    raise ValueError("Bad FEN rank %r" % row)
+                color = "White" if char.isupper() else "Black"
+                piece = piece_class(color, x, y)
+                if piece_class is Pawn:
+                    piece.moved = y != (6 if color == "White" else 1)
+                elif piece_class is King:
+                    piece.moved = not any(right in castling for right in ("KQ" if color == "White" else "kq"))
+                elif piece_class is Rook:
+                    piece.moved = (x, y) not in unmoved
+                board.add_piece(piece)
+                x += 1
+            if x != 8:
+                raise ValueError("Bad FEN rank %r" % row)
+        turn = "White" if side == "w" else "Black"
+        if en_passant != "-":
+            x = ord(en_passant[0]) - 97
+            y = 8 - int(en_passant[1])
+            pawn = board.get_space(x, y + (1 if turn == "White" else -1))
+            if pawn is None or pawn.name != "Pawn":
+                raise ValueError("No pawn to capture en passant on %s" % en_passant)
+            pawn.en_passant = True
+            board.set_en_passant(pawn)
+        board.set_turn(turn)
+        board.halfmove = int(halfmove)
+        board.fullmove = int(fullmove)
+        if board.bitboard is not None:
+            position = board.bitboard.position
+            position.turn = WHITE if turn == "White" else BLACK
+            position.halfmove = board.halfmove
+            position.fullmove = board.fullmove
+            if board.en_passant is not None:
+                position.ep = (board.en_passant.y - board.en_passant.direction) * 8 + board.en_passant.x
+        else:
+            board.compute_spaces()
+            if board.check:
+                board.get_check_moves(None)
+        return board
+
+    # Returns the position as a FEN string. The castling field comes from the King.moved and Rook.moved
+    # flags and the en passant square is given after every double step
+    def fen(self):
+        rows = []
+        for y in range(8):
+            row = ""
+            empty = 0
+            for piece in self.board[y]:
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                letter = FEN_LETTERS[piece.name]
+                row += letter.upper() if piece.color == "White" else letter
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = "".join(char for char, right in FEN_CASTLING if self.castling & right) or "-"
+        if self.en_passant is None:
+            en_passant = "-"
+        else:
+            en_passant = "%s%d" % (chr(97 + self.en_passant.x), 8 - (self.en_passant.y - self.en_passant.direction))
+        return "%s %s %s %s %d %d" % ("/".join(rows), "w" if self.turn == "White" else "b", castling, en_passant,
+                                      self.halfmove, self.fullmove)
 
     # Places all pieces in their starting positions
     def fill_board(self):
@@ -77,10 +443,24 @@ class Board:
         self.add_piece(Bishop("White", 5, 7))
         self.add_piece(Knight("White", 6, 7))
         self.add_piece(Rook("White", 7, 7))
-        for i in range(len(self.white_pieces)):
-            self.white_pieces[i].get_valid_moves(self)
-        for i in range(len(self.black_pieces)):
-            self.black_pieces[i].get_valid_moves(self)
+        for piece in self.white_pieces:
+            piece.get_valid_moves(self)
+        for piece in self.black_pieces:
+            piece.get_valid_moves(self)
+
+    # Recomputes both attack maps from scratch by asking every piece for its moves
+    def compute_spaces(self):
+        self.check = False
+        self.white_spaces = np.zeros((8, 8))
+        self.black_spaces = np.zeros((8, 8))
+        for piece in self.white_pieces:
+            if piece.name != "King":
+                piece.get_valid_moves(self)
+        for piece in self.black_pieces:
+            if piece.name != "King":
+                piece.get_valid_moves(self)
+        self.white_king.get_valid_moves(self)
+        self.black_king.get_valid_moves(self)
 
     # Used for testing
     def print_board(self):
@@ -90,28 +470,77 @@ class Board:
                 output += "| (%d, %d): %12s " % (j, i, self.board[i][j])
             print(output)
 
-    def draw(self, window):
-        for i in range(8):
-            for j in range(8):
-                piece = self.get_space(i, j)
-                if piece is None:
-                    continue
-                window.blit(piece.img, (i * self.square_size + self.sidebar + 10, j * self.square_size + 10))
-
-    def draw_rev(self, window):
-        for i in range(8): # For the black team the board must be reversed
-            for j in range(8):
-                piece = self.get_space(i,j)
-                if (piece == None):
+    # Returns the pieces giving check to king, found with the attack and line tables
+    def checkers(self, king):
+        return self.attackers(king.y * 8 + king.x, "Black" if king.color == "White" else "White", self.occupied)
+
+    # Returns the pieces of color attacking a square, with occupied as the occupied squares. Pawns attack
+    # their diagonals whether or not anything stands there
+    def attackers(self, square, color, occupied):
+        pieces = self.white_pieces if color == "White" else self.black_pieces
+        found = []
+        for name, attacks in (("Knight", KNIGHT_ATTACKS[square]), ("King", KING_ATTACKS[square]),
+                              ("Pawn", PAWN_ATTACKS[BLACK if color == "White" else WHITE][square])):
+            for piece in pieces.of_type(name):
+                if attacks >> (piece.y * 8 + piece.x) & 1:
+                    found.append(piece)
+        x = square & 7
+        y = square >> 3
+        for name in ("Queen", "Rook", "Bishop"):
+            for piece in pieces.of_type(name):
+                origin = piece.y * 8 + piece.x
+                if not LINES[square][origin] or BETWEEN[square][origin] & occupied:
                     continue
-                # 7 - x and 7 - y gives us the reversed coords
-                window.blit(piece.img, ((7-i) * self.square_size + self.sidebar + 10, (7-j) * self.square_size + 10))
-
+                straight = piece.x == x or piece.y == y
+                if name == "Queen" or straight == (name == "Rook"):
+                    found.append(piece)
+        return found
+
+    # Returns a mask of the squares color attacks, with occupied as the occupied squares. Pawns attack
+    # their diagonals whether or not anything stands there
+    def attack_mask(self, color, occupied):
+        pieces = self.white_pieces if color == "White" else self.black_pieces
+        pawn_attacks = PAWN_ATTACKS[WHITE if color == "White" else BLACK]
+        mask = 0
+        for piece in pieces.of_type("Pawn"):
+            mask |= pawn_attacks[piece.y * 8 + piece.x]
+        for piece in pieces.of_type("Knight"):
+            mask |= KNIGHT_ATTACKS[piece.y * 8 + piece.x]
+        for piece in pieces.of_type("King"):
+            mask |= KING_ATTACKS[piece.y * 8 + piece.x]
+        for piece in pieces.of_type("Bishop"):
+            mask |= bishop_attacks(piece.y * 8 + piece.x, occupied)
+        for piece in pieces.of_type("Rook"):
+            mask |= rook_attacks(piece.y * 8 + piece.x, occupied)
+        for piece in pieces.of_type("Queen"):
+            mask |= bishop_attacks(piece.y * 8 + piece.x, occupied) | rook_attacks(piece.y * 8 + piece.x, occupied)
+        return mask
+
+    # Returns the squares of the line a piece is pinned along against its own king, the
+    # pinning piece included, or FULL if it is free to leave it
+    def pin_line(self, piece):
+        king = self.white_king if piece.color == "White" else self.black_king
+        if king is None or king is piece:
+            return FULL
+        square = king.y * 8 + king.x
+        origin = piece.y * 8 + piece.x
+        if not LINES[square][origin] or BETWEEN[square][origin] & self.occupied:
+            return FULL
+        beyond = BEYOND[square][origin] & self.occupied
+        if not beyond:
+            return FULL
+        # The first piece past this one, squares along a line run up or down with the index
+        first = (beyond & -beyond).bit_length() - 1 if origin > square else beyond.bit_length() - 1
+        pinner = self.board[first >> 3][first & 7]
+        straight = piece.x == king.x or piece.y == king.y
+        if pinner.color != piece.color and (pinner.name == "Queen" or pinner.name == ("Rook" if straight else "Bishop")):
+            return LINES[square][origin]
+        return FULL
+
+    # Works out the moves out of check for the side the attacking piece checks: capturing a lone
+    # checker or blocking its line, or only moving the king in double check
     def get_check_moves(self, other_piece):
-        self.check_other_moves = []
-        attacker = self.attacking_piece.name
         attack = self.attacking_piece.color
-        blockable = False
         if attack == "White":
             defense = self.black_spaces
             defender = self.black_king
@@ -119,40 +548,13 @@ class Board:
             defense = self.white_spaces
             defender = self.white_king
         check_king_moves = defender.get_valid_moves(self)
-        self.check_other_moves.append((self.attacking_piece.x, self.attacking_piece.y))
-        if defense[self.attacking_piece.y][self.attacking_piece.x] == 1:
-            blockable = True
-        if attacker == "Queen" or attacker == "Bishop" or attacker == "Rook":
-            directions = ((0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1))
-            x_dif = self.attacking_piece.x - defender.x
-            y_dif = self.attacking_piece.y - defender.y
-            if x_dif < 0:
-                if y_dif < 0:
-                    direction = directions[7]
-                elif y_dif == 0:
-                    direction = directions[6]
-                else:
-                    direction = directions[5]
-            elif x_dif == 0:
-                if y_dif < 0:
-                    direction = directions[0]
-                else:
-                    direction = directions[4]
-            else:
-                if y_dif < 0:
-                    direction = directions[1]
-                elif y_dif == 0:
-                    direction = directions[2]
-                else:
-                    direction = directions[3]
-            dif = max(abs(x_dif), abs(y_dif))
-            for i in range(1, dif):
-                path_space = (defender.x + i * direction[0], defender.y + i * direction[1])
-                self.check_other_moves.append(path_space)
-                if defense[path_space[1]][path_space[0]] == 1:
-                    blockable = True
+        if len(self.checkers(defender)) > 1:
+            self.check_squares = 0
+        else:
+            origin = self.attacking_piece.y * 8 + self.attacking_piece.x
+            self.check_squares = 1 << origin | BETWEEN[defender.y * 8 + defender.x][origin]
+        blockable = any(defense[square >> 3][square & 7] == 1 for square in squares_of(self.check_squares))
         if not check_king_moves and not blockable:
-            print("Checkmate")
             return [2, attack]
         if other_piece is None:
             return [0]
@@ -160,7 +562,11 @@ class Board:
             return [1, other_piece]
 
 
+# Pieces use __slots__ so they carry no instance dictionary: a piece is a few machine words,
+# which keeps positions small for the search's copies and for storing games
 class Piece(ABC):
+    __slots__ = ("direction", "x", "y", "color", "name", "spaces")
+
     @abstractmethod
     def __init__(self, color, name, x, y):
         self.direction = 0
@@ -168,80 +574,77 @@ class Piece(ABC):
         self.y = y
         self.color = color
         self.name = name
-        self.spaces = np.zeros((8, 8))
-        self.path = "assets/" + color + name + ".png"
-        self.img = pygame.image.load(self.path)
+        self.spaces = 0 # Squares reached by the last get_valid_moves, bit y * 8 + x
         super().__init__()
 
     # Returns a list of valid moves for the piece
     @abstractmethod
     def get_valid_moves(self, board, output):
-        self.spaces = np.zeros((8, 8))
+        spaces = 0
+        if self.color == "White":
+            total_spaces = board.white_spaces
+        else:
+            total_spaces = board.black_spaces
         for i in output:
             space = board.get_space(i[0], i[1])
+            spaces |= 1 << (i[1] * 8 + i[0])
             if space is not None and space.color != self.color and space.name == "King":
-                self.spaces[i[1]][i[0]] = 1
                 board.check = True
                 board.attacking_piece = self
-            else:
-                self.spaces[i[1]][i[0]] = 1
-            if self.color == "White":
-                total_spaces = board.white_spaces
-            else:
-                total_spaces = board.black_spaces
             if self.name == "King" and total_spaces[i[1]][i[0]] == 0:
                 total_spaces[i[1]][i[0]] = 2
             else:
                 total_spaces[i[1]][i[0]] = 1
-        if board.check and self.name != "King":
-            restricted_output = []
-            for i in output:
-                for u in board.check_other_moves:
-                    if i == u:
-                        restricted_output.append(i)
-            return restricted_output
-        else:
+        self.spaces = spaces
+        if self.name == "King":
+            return output
+        # A pinned piece stays on its line, and in check only the squares that answer it are left
+        allowed = board.pin_line(self)
+        if board.check:
+            allowed &= board.check_squares
+        if allowed == FULL:
             return output
+        return [i for i in output if allowed >> (i[1] * 8 + i[0]) & 1]
 
     # Moves the piece to the specified space
     def move(self, board, new_x, new_y, en_passant=False, promotion=False):
         captured = False
         board.check = False
-        board.white_spaces = np.zeros((8, 8))
-        board.black_spaces = np.zeros((8, 8))
         if board.en_passant_counter > 0:
             board.en_passant_counter -= 1
         if board.en_passant_counter == 0 and board.en_passant is not None:
             board.en_passant.en_passant = False
-            board.en_passant = None
+            board.set_en_passant(None)
         if en_passant:
             other_piece = board.get_space(new_x, new_y - self.direction)
-        elif promotion:
-            other_piece = None
         else:
             other_piece = board.get_space(new_x, new_y)
         if other_piece is not None:
             captured = True
             board.remove_piece(other_piece)
-        board.board[self.y][self.x] = None
-        board.board[new_y][new_x] = self
+        board.set_space(self.x, self.y, None)
+        board.set_space(new_x, new_y, self)
+        board.attacks.invalidate(self)
+        old_x = self.x
+        old_y = self.y
         self.x = new_x
         self.y = new_y
-        for i in range(len(board.white_pieces)):
-            if board.white_pieces[i].name != "King":
-                board.white_pieces[i].get_valid_moves(board)
-        for i in range(len(board.black_pieces)):
-            if board.black_pieces[i].name != "King":
-                board.black_pieces[i].get_valid_moves(board)
-        board.white_king.get_valid_moves(board)
-        board.black_king.get_valid_moves(board)
+        board.set_castling(board.castling & CASTLE_MASKS[old_y * 8 + old_x] & CASTLE_MASKS[new_y * 8 + new_x])
+        board.halfmove = 0 if captured or self.name == "Pawn" else board.halfmove + 1
+        if self.color == "Black":
+            board.fullmove += 1
+        board.set_turn("Black" if self.color == "White" else "White")
+        if board.bitboard is not None:
+            return board.bitboard.move(self, old_x, old_y, other_piece, promotion)
+        if promotion:
+            # The pawn leaves the board until the promoted piece is added
+            board.remove_piece(self)
+        # Only the pieces whose rays or targets changed are rescanned
+        board.attacks.update()
         if board.check:
             return [*board.get_check_moves(other_piece)]
         if captured:
             return [1, other_piece]
-        if promotion:
-            other_piece = board.get_space(self.x, self.y)
-            board.remove_piece(other_piece)
         
         return [0]
 
@@ -250,11 +653,15 @@ class Piece(ABC):
 
 
 class Queen(Piece):
+    __slots__ = ()
+
     def __init__(self, color, x, y):
         self.name = "Queen"
         super().__init__(color, self.name, x, y)
 
     def get_valid_moves(self, board, output=None):
+        if board.bitboard is not None:
+            return board.bitboard.get_valid_moves(self)
         output = []
         if self.color == "White":
             spaces = board.white_spaces
@@ -413,6 +820,8 @@ class Queen(Piece):
 
 
 class Pawn(Piece):
+    __slots__ = ("moved", "en_passant")
+
     def __init__(self, color, x, y):
         self.name = "Pawn"
         super().__init__(color, self.name, x, y)
@@ -424,6 +833,8 @@ class Pawn(Piece):
             self.direction = 1
 
     def get_valid_moves(self, board, output=None):
+        if board.bitboard is not None:
+            return board.bitboard.get_valid_moves(self)
         output = []
         if self.color == "White":
             spaces = board.white_spaces
@@ -461,13 +872,35 @@ class Pawn(Piece):
             elif space is not None and space.color == self.color:
                 spaces[new_y][new_x] = 1
 
+        capture = None
         if board.en_passant is not None and board.en_passant.color != self.color and board.en_passant.y == self.y:
             if board.en_passant.x == self.x - 1:
-                output.append((self.x - 1, self.y + self.direction))
+                capture = (self.x - 1, self.y + self.direction)
             elif board.en_passant.x == self.x + 1:
-                output.append((self.x + 1, self.y + self.direction))
-
-        return super().get_valid_moves(board, output)
+                capture = (self.x + 1, self.y + self.direction)
+        if capture is not None:
+            output.append(capture)
+
+        output = super().get_valid_moves(board, output)
+        # An en passant capture takes two pieces off one row, which a pin or check line does not see,
+        # so it is checked by looking at the king's attackers once both pawns are gone
+        if capture is not None:
+            legal = self.en_passant_safe(board, *capture)
+            if legal and capture not in output:
+                output.append(capture)
+            elif not legal and capture in output:
+                output.remove(capture)
+        return output
+
+    # Returns whether capturing en passant onto (x, y) leaves the king out of check
+    def en_passant_safe(self, board, x, y):
+        king = board.white_king if self.color == "White" else board.black_king
+        if king is None:
+            return True
+        victim = board.en_passant
+        occupied = board.occupied & ~(1 << (self.y * 8 + self.x)) & ~(1 << (victim.y * 8 + victim.x)) | 1 << (y * 8 + x)
+        enemy = "Black" if self.color == "White" else "White"
+        return all(piece is victim for piece in board.attackers(king.y * 8 + king.x, enemy, occupied))
 
     def move(self, board, new_x, new_y, en_passant=False):
         if new_x != self.x and board.get_space(new_x, new_y) is None:
@@ -479,19 +912,24 @@ class Pawn(Piece):
             return_value = super().move(board, new_x, new_y)
         if not self.moved and (new_y == 3 or new_y == 4):
             self.en_passant = True
-            board.en_passant = self
+            board.set_en_passant(self)
         self.moved = True
+        board.attacks.invalidate(self) # Losing the double step changes the pawn's marks
         
         return return_value
 
 
 class Rook(Piece):
+    __slots__ = ("moved",)
+
     def __init__(self, color, x, y):
         self.name = "Rook"
         super().__init__(color, self.name, x, y)
         self.moved = False
 
     def get_valid_moves(self, board, output=None):
+        if board.bitboard is not None:
+            return board.bitboard.get_valid_moves(self)
         output = []
         if self.color == "White":
             spaces = board.white_spaces
@@ -579,11 +1017,15 @@ class Rook(Piece):
 
 
 class Bishop(Piece):
+    __slots__ = ()
+
     def __init__(self, color, x, y):
         self.name = "Bishop"
         super().__init__(color, self.name, x, y)
 
     def get_valid_moves(self, board, output=None):
+        if board.bitboard is not None:
+            return board.bitboard.get_valid_moves(self)
         output = []
         if self.color == "White":
             spaces = board.white_spaces
@@ -670,11 +1112,15 @@ class Bishop(Piece):
 
 
 class Knight(Piece):
+    __slots__ = ()
+
     def __init__(self, color, x, y):
         self.name = "Knight"
         super().__init__(color, self.name, x, y)
 
     def get_valid_moves(self, board, output=None):
+        if board.bitboard is not None:
+            return board.bitboard.get_valid_moves(self)
         output = []
         if self.color == "White":
             spaces = board.white_spaces
@@ -757,25 +1203,32 @@ class Knight(Piece):
 
 
 class King(Piece):
+    __slots__ = ("moved",)
+
     def __init__(self, color, x, y):
         self.name = "King"
         super().__init__(color, self.name, x, y)
         self.moved = False
 
     def get_valid_moves(self, board, output=None):
+        if board.bitboard is not None:
+            return board.bitboard.get_valid_moves(self)
         output = []
         if self.color == "White":
             spaces = board.white_spaces
-            blocked_spaces = board.black_spaces
+            enemy = "Black"
         else:
             spaces = board.black_spaces
-            blocked_spaces = board.white_spaces
+            enemy = "White"
+        # Squares the other side attacks, worked out without the king on its square so the squares
+        # behind it on a checking line count as attacked
+        danger = board.attack_mask(enemy, board.occupied & ~(1 << (self.y * 8 + self.x)))
 
         # Up
         new_x = self.x
         new_y = self.y - 1
         if new_y >= 0:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
@@ -786,7 +1239,7 @@ class King(Piece):
         new_x = self.x + 1
         new_y = self.y - 1
         if new_x < board.shape[1] and new_y >= 0:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
@@ -797,7 +1250,7 @@ class King(Piece):
         new_x = self.x + 1
         new_y = self.y
         if new_x < board.shape[1]:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
@@ -808,7 +1261,7 @@ class King(Piece):
         new_x = self.x + 1
         new_y = self.y + 1
         if new_x < board.shape[1] and new_y < board.shape[0]:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
@@ -819,7 +1272,7 @@ class King(Piece):
         new_x = self.x
         new_y = self.y + 1
         if new_y < board.shape[0]:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
@@ -830,7 +1283,7 @@ class King(Piece):
         new_x = self.x - 1
         new_y = self.y + 1
         if new_x >= 0 and new_y < board.shape[0]:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
@@ -841,7 +1294,7 @@ class King(Piece):
         new_x = self.x - 1
         new_y = self.y
         if new_x >= 0:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
@@ -852,25 +1305,26 @@ class King(Piece):
         new_x = self.x - 1
         new_y = self.y - 1
         if new_x >= 0 and new_y >= 0:
-            if blocked_spaces[new_y][new_x] == 0:
+            if not danger >> (new_y * 8 + new_x) & 1:
                 space = board.get_space(new_x, new_y)
                 if space is None or space.color != self.color:
                     output.append((new_x, new_y))
             elif spaces[new_y][new_x] == 0:
                 spaces[new_y][new_x] = 2
 
-        # Castling
-        if not self.moved:
+        # Castling, out of check and over squares that are not attacked
+        safe = lambda x: not danger >> (self.y * 8 + x) & 1
+        if not self.moved and safe(self.x):
             left_corner = board.get_space(0, self.y)
             right_corner = board.get_space(7, self.y)
             if left_corner is not None and left_corner.color == self.color and left_corner.name == "Rook" \
                     and not left_corner.moved and board.get_space(1, self.y) is None \
                     and board.get_space(2, self.y) is None and board.get_space(3, self.y) is None \
-                    and blocked_spaces[self.y][0] == 0:
+                    and safe(3) and safe(2):
                 output.append((2, self.y))
             if right_corner is not None and right_corner.color == self.color and right_corner.name == "Rook" \
                     and not right_corner.moved and board.get_space(5, self.y) is None \
-                    and board.get_space(6, self.y) is None and blocked_spaces[self.y][7] == 0:
+                    and board.get_space(6, self.y) is None and safe(5) and safe(6):
                 output.append((6, self.y))
 
         return super().get_valid_moves(board, output)
@@ -879,14 +1333,16 @@ class King(Piece):
         if not self.moved:
             if new_x == 2:
                 rook = board.get_space(0, self.y)
-                board.board[self.y][0] = None
-                board.board[self.y][3] = rook
+                board.set_space(0, self.y, None)
+                board.set_space(3, self.y, rook)
+                board.attacks.invalidate(rook)
                 rook.x = 3
                 rook.y = self.y
             elif new_x == 6:
                 rook = board.get_space(7, self.y)
-                board.board[self.y][7] = None
-                board.board[self.y][5] = rook
+                board.set_space(7, self.y, None)
+                board.set_space(5, self.y, rook)
+                board.attacks.invalidate(rook)
                 rook.x = 5
                 rook.y = self.y
         return_value = super().move(board, new_x, new_y)
@@ -894,6 +1350,10 @@ class King(Piece):
         return return_value
 
 
+# Piece class of each FEN letter, used by Board.from_fen
+FEN_CLASSES = {"p": Pawn, "n": Knight, "b": Bishop, "r": Rook, "q": Queen, "k": King}
+
+
 # Testing
 if __name__ == "__main__":
     board = Board(100, 250)
@@ -0,0 +1,49 @@
+import argparse
+import time
+from classes import Board
+from replay import random_games, PROMOTION_CLASSES
+
+
+# Plays the games on a Board and returns the FEN string of every position reached
+def game_fens(games):
+    fens = []
+    for moves in games:
+        board = Board(100, 250)
+        board.fill_board()
+        fens.append(board.fen())
+        for move in moves:
+            frm = move & 63
+            to = move >> 6 & 63
+            board.make_move(board.get_space(frm & 7, frm >> 3), to & 7, to >> 3, PROMOTION_CLASSES.get(move >> 12))
+            fens.append(board.fen())
+    return fens
+
+
+# Loads every FEN string and writes it back out, checking the round trip gives the same string.
+# Returns the seconds spent in Board.from_fen and in Board.fen
+def round_trip(fens, backend="objects"):
+    boards = []
+    start = time.perf_counter()
+    for fen in fens:
+        boards.append(Board.from_fen(fen, backend=backend))
+    middle = time.perf_counter()
+    written = [board.fen() for board in boards]
+    end = time.perf_counter()
+    for fen, text in zip(fens, written):
+        if fen != text:
+            raise AssertionError("FEN round trip differs:\n%s\n%s" % (fen, text))
+    return middle - start, end - middle
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how many positions per second Board.from_fen loads and Board.fen writes")
+    parser.add_argument("games", nargs="?", type=int, default=50)
+    parser.add_argument("--backend", choices=("objects", "bitboard"), default="objects")
+    parser.add_argument("--plies", type=int, default=200, help="Moves after which a game is cut short")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    fens = game_fens(random_games(args.games, args.seed, args.plies))
+    loading, writing = round_trip(fens, args.backend)
+    print("%d positions" % len(fens))
+    print("from_fen  %8.2fs %10.0f positions/s" % (loading, len(fens) / loading))
+    print("fen       %8.2fs %10.0f positions/s" % (writing, len(fens) / writing))
@@ -1,16 +1,82 @@
 from classes import *
+from search import Search
+from messages import MessageQueue
+from network import Client
+from instruments import Instruments, BUCKETS
+import protocol
 import pygame
 import pygame_menu
-import websocket
+import argparse
+import atexit
+import socket
+import time
 try:
     import thread
 except ImportError:
     import _thread as thread
-import time
+from collections import OrderedDict, deque
+
+PIECE_NAMES = ("Pawn", "Knight", "Bishop", "Rook", "Queen", "King")
+SERVER_URL = "ws://claytonfalciani.com"
+MESSAGE_EVENT = pygame.USEREVENT + 1 # Posted by the network thread to wake the game loop when a message arrives
+
+# Loads each piece image once, converted to the display's pixel format, and hands out the
+# same surface for every piece of that color and type, promoted pieces included
+class SpriteCache:
+    def __init__(self, folder="assets"):
+        self.folder = folder
+        self.images = {} # (color, piece name) -> image
+
+    # Needs the display to be set up first for convert_alpha
+    def load_all(self):
+        for color in ("White", "Black"):
+            for name in PIECE_NAMES:
+                self.get(color, name)
+
+    def get(self, color, name):
+        image = self.images.get((color, name))
+        if image is None:
+            image = pygame.image.load(self.folder + "/" + color + name + ".png").convert_alpha()
+            self.images[(color, name)] = image
+        return image
+
+# Keeps the most recently used rendered strings so each one is rasterized once instead of every frame
+class TextCache:
+    def __init__(self, background, size=256):
+        self.background = background
+        self.size = size
+        self.surfaces = OrderedDict() # (string, color, font) -> surface, least recently used first
+
+    def render(self, text, color, font):
+        key = (text, color, font)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = font.render(text, True, color, self.background)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
 
 class Game:
-    def __init__(self):
+    def __init__(self, url=SERVER_URL, stats=None, binary=False):
         pygame.init()
+        # With stats set to a file name, timings and queue depths are recorded, shown on an
+        # overlay toggled with F3 and written to that file (.json or .csv) when the game exits
+        self.instruments = None
+        self.overlay = False # Showing the instruments overlay
+        self.overlay_frame = 0 # Counts overlay draws so it is redrawn every frame
+        self.sending = deque() # When each message still in the network outbox was queued
+        self.arrivals = deque() # When each move waiting in the inbox arrived
+        self.move_sent_at = None # When our last move went out, until the opponent answers
+        self.unanswered = None # Value of our last move until the opponent answers, while the relay may still refuse it
+        if stats is not None:
+            self.instruments = Instruments()
+            pieces = [Piece] + Piece.__subclasses__()
+            self.instruments.time_method(pieces, "move", "Piece.move")
+            self.instruments.time_method(pieces, "get_valid_moves", "get_valid_moves")
+            atexit.register(self.instruments.dump, stats)
         # Hold the captured pieces for both teams for display
         self.captured = {
             "White": {
@@ -28,26 +94,39 @@ class Game:
                 "Queen": [],
             }
         }
-        self.messageAvailable = False # set to true if a new message is recieved. Should be set to false once read
-        self.message = "" # Contains the new message, will be overwritten only when messageAvailable is false
+        self.inbox = MessageQueue() # Messages from the opponent, pushed by the network thread and handled by the game loop
+        self.messages_per_frame = 16 # Most messages handled before the next frame is drawn
+        self.binary = binary # Send the compact binary messages. server.js only relays the text ones, relay.py takes both
         self.team = "" # Will be set with wich team the player is on upon connection. Eg: "white" or "black"
         self.ready = False # Are both players connected?
         self.my_turn = False # True if it is this players turn
-        #websocket.enableTrace(True)
-        self.ws = websocket.WebSocketApp("ws://claytonfalciani.com", # Connect the web server to my server
-                                on_message = lambda ws,msg: self.on_message(ws,msg), # Function to handle messages
-                                on_error = lambda ws,err: self.on_error(ws,err), #Function to handle errors
-                                on_close = lambda ws: self.on_close(ws), #Function to handle close the server
-                                on_open = lambda ws: self.on_open(ws)) # Function to handle opening the server
+        self.computer = None # Search used for the opponent's moves when playing against the computer
+        self.computer_time = 2 # Seconds the computer may think about each move
+        self.computer_thinking = False # True while the computer's search thread is running
+        self.fps = 30 # Most frames drawn per second
+        self.idle_timeout = 500 # Milliseconds to sleep waiting for an event when nothing changes
+        self.redraw = True # Set whenever something on screen changed and the game needs drawing again
+        self.drawn = None # What each screen region showed when last drawn, None to draw the whole window
+        self.clock = pygame.time.Clock()
+        self.network = Client(url, # Connect the web server to my server
+                              on_message = self.on_message, # Function to handle messages
+                              on_error = self.on_error, #Function to handle errors
+                              on_close = self.on_close, #Function to handle close the server
+                              on_sent = self.on_sent if self.instruments is not None else None,
+                              heartbeat_message = protocol.encode(("heartbeat",)) if self.binary else "hb")
 
         #UNCOMMENT BELOW LINE TO CONNECT TO SERVER!
-        thread.start_new_thread(self.ws.run_forever, ()) # Start listening for messages on a new thread so we don't block the game
+        self.network.start() # Connect and listen for messages on the network thread so we don't block the game
         self.square_size = 100
+        self.sprites = SpriteCache()
         self.white_color = (240,240,240)
         self.black_color = (20,20,20)
+        self.texts = TextCache(self.white_color)
+        self.board_layers = {} # team -> the board, border lines and labels drawn from that side
         self.sidebar_size = 250
         self.left_sidebar = self.sidebar_size # X coordinate of the left side bar (it starts at 0 and ends at this point)
-        self.board = Board(self.square_size, self.sidebar_size)
+        # The bitboard backend follows the same rules as the relay's referee, see validation.py
+        self.board = Board(self.square_size, self.sidebar_size, backend="bitboard")
         self.board.fill_board()
         self.right_sidebar = self.sidebar_size + self.board.shape[0] * self.square_size # X coordinate of the right sidebar
         self.header_font = pygame.font.Font('freesansbold.ttf', int(self.board.shape[1] * self.square_size * .03))
@@ -64,6 +143,7 @@ class Game:
         # Set window name and icon
         pygame.display.set_caption("Chess")
         pygame.display.set_icon(pygame.image.load('assets/WhiteRook.png'))
+        self.sprites.load_all()
 
         #MAIN MENU COMPONENTS
         #Conecting Animation images
@@ -85,51 +165,35 @@ class Game:
         while 1:
             if (self.ready):
                 # Run the game
-                if self.messageAvailable: # check if theres a message available
-                    if self.message.split()[0] == "Black":
-                        if self.message.split()[1] == "Queen":
-                            self.board.add_piece(Queen("Black", int(self.message.split()[2]), int(self.message.split()[3])))
-                        elif self.message.split()[1] == "Bishop":
-                            self.board.add_piece(Bishop("Black", int(self.message.split()[2]), int(self.message.split()[3])))
-                        elif self.message.split()[1] == "Knight":
-                            self.board.add_piece(Knight("Black", int(self.message.split()[2]), int(self.message.split()[3])))
-                        elif self.message.split()[1] == "Rook":
-                            self.board.add_piece(Rook("Black", int(self.message.split()[2]), int(self.message.split()[3])))
-                        
-                        self.messageAvailable = False # make sure to tell the game you have read the message
-                    elif self.message.split()[0] == "White":
-                        if self.message.split()[1] == "Queen":
-                            self.board.add_piece(Queen("White", int(self.message.split()[2]), int(self.message.split()[3])))
-                        elif self.message.split()[1] == "Bishop":
-                            self.board.add_piece(Bishop("White", int(self.message.split()[2]), int(self.message.split()[3])))
-                        elif self.message.split()[1] == "Knight":
-                            self.board.add_piece(Knight("White", int(self.message.split()[2]), int(self.message.split()[3])))
-                        elif self.message.split()[1] == "Rook":
-                            self.board.add_piece(Rook("White", int(self.message.split()[2]), int(self.message.split()[3])))
-                        
-                        self.messageAvailable = False # make sure to tell the game you have read the message
+                if self.computer is not None and not self.my_turn and not self.computer_thinking and not self.game_over:
+                    # Search on a copy in another thread so the window keeps drawing while the computer thinks
+                    self.computer_thinking = True
+                    thread.start_new_thread(self.computer_move, (self.board.copy("bitboard"),))
+                if self.instruments is not None:
+                    self.instruments.record("inbox", len(self.inbox), "messages")
+                    self.instruments.record("outbox", len(self.sending), "messages")
+                for message in self.inbox.drain(self.messages_per_frame): # Handle the messages that arrived since the last frame
+                    self.redraw = True
+                    self.handle_message(message)
+
+                if self.redraw or self.overlay:
+                    self.redraw = False
+                    if self.instruments is not None:
+                        with self.instruments.timer("Game.draw"):
+                            self.draw()
                     else:
-                        print(self.message)
-                        # Process message for display. Array is 0 based but the actual board is not
-                        message = self.message[0].upper()
-                        message += str(8 - int(self.message[1]))
-                        message += " to "
-                        message += self.message[3].upper()
-                        message += str(8 - int(self.message[4]))
-                        # Display message on activity board
-                        self.activity_texts.append(("Opponent: " + message, (134,134,134), self.text_font))
-                        # And processing with the message should go here
-                        origin = ord(self.message[0]) - 97, int(self.message[1])
-                        dest = ord(self.message[3]) - 97, int(self.message[4])
-                        piece = self.board.get_space(*origin)
-                        move_val = piece.move(self.board, *dest)
-                        self.handle_move(move_val)
-                        self.messageAvailable = False # make sure to tell the game you have read the message
-                        self.my_turn = True
-
-                self.draw()
+                        self.draw()
+                self.clock.tick(self.fps)
 
-                for event in pygame.event.get():
+                events = pygame.event.get()
+                if not events and not len(self.inbox):
+                    # Nothing to do, sleep until there is input, a message or the timeout passes
+                    events = [pygame.event.wait(self.idle_timeout)]
+                for event in events:
+                    if event.type not in (pygame.NOEVENT, pygame.MOUSEMOTION):
+                        self.redraw = True
+                    if event.type == pygame.VIDEOEXPOSE:
+                        self.drawn = None # The window contents were lost
                     # Test for any user input
                     if event.type == pygame.MOUSEBUTTONUP:
                         if self.my_turn:
@@ -140,19 +204,17 @@ class Game:
                                 else:
                                     square = self.coords_to_square(coords)
                                 if square in self.moves:
-                                    move_str = chr(self.selected_piece.x + 97) + str(self.selected_piece.y) + " " + chr(square[0] + 97) + str(square[1])
-                                    message = move_str[0].upper()
-                                    message += str(8 - int(move_str[1]))
-                                    message += " to "
-                                    message += move_str[3].upper()
-                                    message += str(8 - int(move_str[4]))
+                                    move = ("move", self.selected_piece.x, self.selected_piece.y, square[0], square[1])
+                                    message = self.describe_move(move)
                                     self.activity_texts.append(("You: " + message, (134,134,134), self.text_font))
-                                    self.ws.send(move_str)
-                                    move_val = self.selected_piece.move(self.board, *square)
+                                    self.send(move)
+                                    # Played with make_move so it can be taken back if the relay refuses it
+                                    move_val = self.board.make_move(self.selected_piece, *square)
                                     self.handle_move(move_val) 
                                     self.selected_piece = None
                                     self.moves = []
                                     self.my_turn = False
+                                    self.unanswered = move_val
                                     continue
                                 self.selected_piece = self.board.get_space(*square)
                                 
@@ -164,44 +226,48 @@ class Game:
                             else:
                                 self.selected_piece = None
                                 self.moves = []
+                    if event.type == pygame.KEYDOWN and event.key == pygame.K_F3 and self.instruments is not None:
+                        # Press F3 to show or hide the timings
+                        self.overlay = not self.overlay
                     if (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE) or event.type == pygame.QUIT:
                         # Press escape to quit
-                        try:
-                            self.ws.send("quit")
-                        except websocket._exceptions.WebSocketConnectionClosedException:
-                            pass
+                        self.send(("quit",))
+                        self.network.close(1) # Give the quit message a moment to go out
                         pygame.quit()
                         quit()
             #Main Menu               
             else:
                 self.drawMainMenu()
+                self.clock.tick(self.fps) # The animation keeps running, just not faster than needed
                 for event in pygame.event.get():
                     if (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE) or event.type == pygame.QUIT:
                         # Press escape to quit
-                        try:
-                            self.ws.send("quit")
-                        except websocket._exceptions.WebSocketConnectionClosedException:
-                            pass
+                        self.send(("quit",))
+                        self.network.close(1) # Give the quit message a moment to go out
                         pygame.quit()
                         quit()
+                    if event.type == pygame.KEYDOWN and event.key == pygame.K_c:
+                        # Press C to play against the computer instead of waiting for an opponent
+                        self.start_computer_game()
 
     def drawMainMenu(self):
         self.window.fill(self.white_color)
         self.window.blit(self.background, (0, 0))
 
         #Text
-        loadingText = self.text_font.render("Waiting for other player to connect...", True, (255,0,0), self.white_color)
+        loadingText = self.texts.render("Waiting for other player to connect...", (255,0,0), self.text_font)
         self.window.blit(loadingText, (550, 680))
-        pressText = self.text_font.render("Press", True, (0,0,0), self.white_color)
+        pressText = self.texts.render("Press", (0,0,0), self.text_font)
         self.window.blit(pressText, (636, 725))
-        escText = self.text_font.render("[ Esc ]", True, (0,0,0), self.white_color)
+        escText = self.texts.render("[ Esc ]", (0,0,0), self.text_font)
         self.window.blit(escText, (635, 740))
-        quitText = self.text_font.render("to quit", True, (0,0,0), self.white_color)
+        quitText = self.texts.render("to quit", (0,0,0), self.text_font)
         self.window.blit(quitText, (635, 755))
+        computerText = self.texts.render("Press [ C ] to play the computer", (0,0,0), self.text_font)
+        self.window.blit(computerText, (565, 785))
 
         
         #Title & Connecting animation
-        pygame.time.delay(25)
         self.window.blit(self.loadingAnimation[self.frame], (550, 480))
         self.window.blit(self.chessAnimation[self.frame], (505, 260))
         self.frame += 1
@@ -211,25 +277,58 @@ class Game:
         pygame.display.update()
         
 
+    # Works out what changed on screen since the last frame and redraws only those rectangles
     def draw(self):
-        self.draw_board()
-        text = self.header_font.render("Your Turn" if self.my_turn else "Opponents Turn", True, (255,0,0), self.white_color)
-        self.window.blit(text, (self.right_sidebar + 20,0))
         y = len(self.activity_texts) * 30
         if y - self.window.get_size()[1] >= 30:
             self.activity_texts.pop(1)
             self.activity_texts.pop(1)
-        for index,text in enumerate(self.activity_texts):
-            self.draw_text((0, index * 30), *text)
-        for move in self.moves:
-            if self.team == "black":
-                self.draw_square((150,180,255), *self.board.flip(*move))
-            else:
-                self.draw_square((150,180,255), *move)
-        if self.team == "black":
-            self.board.draw_rev(self.window)
+        regions = self.screen_regions()
+        if self.drawn is None:
+            dirty = [self.window.get_rect()]
         else:
-            self.board.draw(self.window)
+            dirty = [rect for key, (rect, value) in regions.items() if self.drawn.get(key) != (rect, value)]
+            # Regions that are gone, like an activity log line that scrolled away, need clearing too
+            dirty += [rect for key, (rect, value) in self.drawn.items() if key not in regions]
+        self.drawn = regions
+        for rect in dirty:
+            self.draw_area(rect)
+        if dirty:
+            pygame.display.update(dirty)
+
+    # Maps every part of the screen that can change to its rectangle and what it currently shows
+    def screen_regions(self):
+        regions = {}
+        for y in range(8):
+            for x in range(8):
+                square = self.board.flip(x, y) if self.team == "black" else (x, y)
+                piece = self.board.get_space(*square)
+                value = None if piece is None else (piece.color, piece.name)
+                regions[("square", x, y)] = (self.square_rect(x, y), (value, square in self.moves))
+        regions["turn"] = (self.turn_rect(), self.turn_text())
+        for index, text in enumerate(self.activity_texts):
+            regions[("log", index)] = (pygame.Rect(0, index * 30, self.left_sidebar - 1, 30), text)
+        for index, color in enumerate(self.captured):
+            counts = tuple(len(images) for images in self.captured[color].values())
+            regions[("captured", color)] = (pygame.Rect(self.right_sidebar + 1, index * 200 + 100, self.sidebar_size, 200), counts)
+        if self.game_over:
+            regions["game over"] = (self.game_over_rect(), True)
+        if self.overlay:
+            self.overlay_frame += 1
+            regions["overlay"] = (self.overlay_rect(), self.overlay_frame)
+        return regions
+
+    # Redraws everything that overlaps area, clipped to it
+    def draw_area(self, area):
+        self.window.set_clip(area)
+        self.draw_board(area)
+        if self.turn_rect().colliderect(area):
+            text = self.texts.render(self.turn_text(), (255,0,0), self.header_font)
+            self.window.blit(text, (self.right_sidebar + 20,0))
+        for index,text in enumerate(self.activity_texts):
+            if area.colliderect((0, index * 30, self.left_sidebar, 30)):
+                self.draw_text((0, index * 30), *text)
+        self.draw_pieces(area)
         for index1, color in enumerate(self.captured):
             for index2,piece in enumerate(self.captured[color]):
                 if len(self.captured[color][piece]) != 0:
@@ -240,35 +339,95 @@ class Game:
                         else:
                             #Second row of pieces must be spaced further so pawns have room to stack
                             self.window.blit(img, (self.right_sidebar + index2*140 + index3*10, index1 * 200 + 100))
-        if self.game_over:
-            center = self.window.get_size()
-            coords = center[0] // 2 - self.game_over_text.get_rect().width //2 , center[1] //2
-            self.window.blit(self.game_over_text, coords)
+        if self.game_over and self.game_over_rect().colliderect(area):
+            self.window.blit(self.game_over_text, self.game_over_rect())
+        if self.overlay and self.overlay_rect().colliderect(area):
+            self.draw_overlay()
+        self.window.set_clip(None)
 
-        pygame.display.update()
-    
-    def draw_board(self):
-        self.window.fill(self.white_color)
-        start = 1
+    def overlay_rect(self):
+        height = self.window.get_size()[1] // 2
+        return pygame.Rect(0, self.window.get_size()[1] - height, self.left_sidebar - 40, height) # Clear of the rank labels
+
+    # Draws each measurement's percentiles over a histogram of its recent samples
+    def draw_overlay(self):
+        rect = self.overlay_rect()
+        self.window.fill((30,30,30), rect)
+        row_height = 50
+        bar_width = (rect.width - 10) // (len(BUCKETS) + 1)
+        for index, series in enumerate(list(self.instruments.series.values())[:rect.height // row_height]):
+            top = rect.top + index * row_height + 4
+            summary = series.summary()
+            # The numbers change every frame, so they are not worth keeping in the text cache
+            text = "%s p50 %.2f p99 %.2f %s" % (series.name, summary["p50"], summary["p99"], series.unit)
+            self.window.blit(self.text_font.render(text, True, (240,240,240)), (rect.left + 5, top))
+            counts = series.histogram()
+            most = max(counts) or 1
+            for bucket, count in enumerate(counts):
+                height = 28 * count // most
+                self.window.fill((150,180,255), (rect.left + 5 + bucket * bar_width, top + 46 - height, bar_width - 1, height))
+
+    def turn_text(self):
+        return "Your Turn" if self.my_turn else "Opponents Turn"
+
+    def turn_rect(self):
+        return pygame.Rect(self.right_sidebar + 1, 0, self.sidebar_size, self.header_font.get_linesize())
+
+    def game_over_rect(self):
+        center = self.window.get_size()
+        rect = self.game_over_text.get_rect()
+        rect.topleft = center[0] // 2 - rect.width //2 , center[1] //2
+        return rect
+
+    def square_rect(self, x, y):
+        return pygame.Rect(self.get_corner_coords(x, y), (self.square_size, self.square_size))
+
+    def draw_board(self, area):
+        self.window.blit(self.board_layer(), area.topleft, area)
+
+    # Returns the parts of the game screen that never change during a game, drawn once for each side
+    def board_layer(self):
+        surface = self.board_layers.get(self.team)
+        if surface is not None:
+            return surface
+        surface = pygame.Surface(self.window.get_size()).convert()
+        surface.fill(self.white_color)
         for i in range(self.board.shape[0]):
-            for j in range(start, self.board.shape[1], 2):
+            for j in range(self.board.shape[1]):
                 # Form a grid shape
-                self.draw_square(self.black_color, j, i)
-            start = int(not start) #Alternate a between 0 and 1
+                if (i + j) % 2 == 1:
+                    surface.fill(self.black_color, self.square_rect(j, i))
         #Draw the border lines on the left and right sidebar
-        pygame.draw.line(self.window, (0,0,0), (self.left_sidebar,0), (self.left_sidebar, self.board.shape[1] * self.square_size), 2)
-        pygame.draw.line(self.window, (0,0,0), (self.right_sidebar,0), (self.right_sidebar, self.board.shape[1] * self.square_size), 2)
-        pygame.draw.line(self.window, (0,0,0), (self.left_sidebar, self.board.shape[1] * self.square_size), (self.right_sidebar, self.board.shape[1] * self.square_size), 2)
+        pygame.draw.line(surface, (0,0,0), (self.left_sidebar,0), (self.left_sidebar, self.board.shape[1] * self.square_size), 2)
+        pygame.draw.line(surface, (0,0,0), (self.right_sidebar,0), (self.right_sidebar, self.board.shape[1] * self.square_size), 2)
+        pygame.draw.line(surface, (0,0,0), (self.left_sidebar, self.board.shape[1] * self.square_size), (self.right_sidebar, self.board.shape[1] * self.square_size), 2)
         for index,value in enumerate(self.vertical_label):
-            text = self.header_font.render(value, True, (0,0,0), self.white_color)
-            self.window.blit(text, (self.sidebar_size - 30, index * self.square_size + 40))
+            surface.blit(self.texts.render(value, (0,0,0), self.header_font), (self.sidebar_size - 30, index * self.square_size + 40))
         for index,value in enumerate(self.horizontal_label):
-            text = self.header_font.render(value, True, (0,0,0), self.white_color)
-            self.window.blit(text, (self.sidebar_size + (index * self.square_size) + 40, self.board.shape[1]*self.square_size + 30))
+            surface.blit(self.texts.render(value, (0,0,0), self.header_font), (self.sidebar_size + (index * self.square_size) + 40, self.board.shape[1]*self.square_size + 30))
+        self.board_layers[self.team] = surface
+        return surface
+
+    # The rules in classes.py know nothing about images, pieces are mapped to their sprites here
+    def sprite(self, piece):
+        return self.sprites.get(piece.color, piece.name)
+
+    # Draws the move highlights and pieces on the squares that overlap area
+    def draw_pieces(self, area):
+        for x in range(8):
+            for y in range(8):
+                if not self.square_rect(x, y).colliderect(area):
+                    continue
+                # For the black team the board must be reversed, 7 - x and 7 - y gives us the reversed coords
+                square = self.board.flip(x, y) if self.team == "black" else (x, y)
+                if square in self.moves:
+                    self.draw_square((150,180,255), x, y)
+                piece = self.board.get_space(*square)
+                if piece is not None:
+                    self.window.blit(self.sprite(piece), (x * self.square_size + self.sidebar_size + 10, y * self.square_size + 10))
 
     def draw_text(self, coords, text, color, font):
-        text = font.render(text, True, color, self.white_color)
-        self.window.blit(text, coords)
+        self.window.blit(self.texts.render(text, color, font), coords)
 
     def draw_square(self, color, x, y):
         # Input a color to make the square, 
@@ -277,8 +436,53 @@ class Game:
         rect = (corner[0], corner[1], self.square_size, self.square_size)
         pygame.draw.rect(self.window, color, rect)
 
+    def handle_message(self, message):
+        if self.instruments is not None and message[0] == "move" and self.arrivals:
+            self.instruments.record("inbox wait", (time.perf_counter() - self.arrivals.popleft()) * 1000)
+        if message[0] == "error":
+            # The relay refused our last message. Take our move back so the boards agree again
+            print("ERROR: " + message[1])
+            if self.unanswered is not None and self.board.undo_stack:
+                self.board.unmake_move()
+                val = self.unanswered[1] if self.unanswered[0] == 3 else self.unanswered
+                if val[0] == 1:
+                    self.captured[val[1].color][val[1].name].pop()
+                self.activity_texts.append(("Refused: " + message[1], (134,134,134), self.text_font))
+                self.unanswered = None
+                self.my_turn = True
+            return
+        if message[0] == "team":
+            # After a reconnect the relay paired us into a new game, the old one is over
+            self.reset_board()
+            self.start_game(message[1])
+            return
+        if message[0] == "promotion":
+            # The opponent chose the piece for a pawn promotion
+            color, name, x, y = message[1:]
+            piece_class = {"Queen": Queen, "Bishop": Bishop, "Knight": Knight, "Rook": Rook}[name]
+            self.board.add_piece(piece_class(color, x, y))
+            return
+        print(protocol.encode_text(message))
+        # Display message on activity board
+        self.activity_texts.append(("Opponent: " + self.describe_move(message), (134,134,134), self.text_font))
+        piece = self.board.get_space(message[1], message[2])
+        if piece is None:
+            print("ERROR: The opponent moved from an empty square")
+            return
+        move_val = piece.move(self.board, message[3], message[4])
+        self.handle_move(move_val)
+        self.unanswered = None
+        self.my_turn = True
+        self.computer_thinking = False
+
+    # Names a move message for the activity log, e.g. "E2 to E4". Array is 0 based but the actual board is not
+    def describe_move(self, message):
+        x, y, new_x, new_y = message[1:]
+        return chr(x + 65) + str(8 - y) + " to " + chr(new_x + 65) + str(8 - new_y)
+
     def handle_move(self, val):
         if val[0] == 2:
+            print("Checkmate")
             self.end(val[1])
             return
         elif val[0] == 3:
@@ -288,7 +492,11 @@ class Game:
         if val[0] == 1:
             #There was a capture!
             piece = val[1]
-            self.captured[piece.color][piece.name].append(piece.img)
+            if piece.name == "King":
+                # Only possible after a move that left the king in check
+                self.end("White" if piece.color == "Black" else "Black")
+                return
+            self.captured[piece.color][piece.name].append(self.sprite(piece))
             return
         return
 
@@ -297,67 +505,87 @@ class Game:
         self.val = val
         if val[2] == 'Black' and self.team == "black":
             self.menu.mainloop(self.window)
+            self.drawn = None # The menu drew over the board
             
         elif val[2] == 'White' and self.team == "white":
             self.menu.mainloop(self.window)
+            self.drawn = None
 
     def promotionQueen(self):
-        if self.val[2] == 'Black': 
-            self.board.add_piece(Queen("Black", self.val[3], self.val[4]))
-            promMsg = "Black Queen " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
-
-        else:
-            self.board.add_piece(Queen("White", self.val[3], self.val[4]))
-            promMsg = "White Queen " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
-        
-        self.menu.disable()
-        pass
+        self.promote(Queen)
 
     def promotionBishop(self):
-        if self.val[2] == 'Black': 
-            self.board.add_piece(Bishop("Black", self.val[3], self.val[4]))
-            promMsg = "Black Bishop " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
-        else:
-            self.board.add_piece(Bishop("White", self.val[3], self.val[4]))
-            promMsg = "White Bishop " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
-
-        self.menu.disable()
-        pass
+        self.promote(Bishop)
 
     def promotionKnight(self):
-        if self.val[2] == 'Black': 
-            self.board.add_piece(Knight("Black", self.val[3], self.val[4]))
-            promMsg = "Black Knight " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
-        else:
-            self.board.add_piece(Knight("White", self.val[3], self.val[4]))
-            promMsg = "White Knight " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
-        self.menu.disable()
-        pass
+        self.promote(Knight)
 
     def promotionRook(self):
-        if self.val[2] == 'Black': 
-            self.board.add_piece(Rook("Black", self.val[3], self.val[4]))
-            promMsg = "Black Rook " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
-        else:
-            self.board.add_piece(Rook("White", self.val[3], self.val[4]))
-            promMsg = "White Knight " + str(self.val[3]) + " " + str(self.val[4])
-            self.ws.send(promMsg)
+        self.promote(Rook)
+
+    def promote(self, piece_class):
+        color, x, y = self.val[2], self.val[3], self.val[4]
+        self.board.add_piece(piece_class(color, x, y))
+        self.send(("promotion", color, piece_class.__name__, x, y))
         self.menu.disable()
-        pass
-        
 
     def end(self, attack):
-        self.ws.send("quit")
+        self.send(("quit",))
         self.game_over_text = self.header_font.render(attack + " Wins!",True, (0,0,255))
         self.game_over = True
 
+    # Sends a protocol message tuple to the opponent. There is nobody to tell when playing the computer
+    def send(self, message):
+        if self.computer is not None:
+            return
+        if self.instruments is not None:
+            self.sending.append(time.perf_counter())
+        self.network.send(protocol.encode(message) if self.binary else protocol.encode_text(message))
+
+    # Sets up the labels and turn for playing on a team, "white" or "black"
+    def start_game(self, team):
+        self.team = team #Grab the team this client is on
+        print("You are on team: " + self.team)
+        if self.team == "white":
+            self.horizontal_label = ["A","B","C","D","E","F","G","H"]
+            self.vertical_label = ["8", "7", "6", "5", "4", "3", "2", "1"]
+        else:
+            self.horizontal_label = ["H","G","F","E","D","C","B","A"]
+            self.vertical_label = ["1", "2", "3", "4", "5", "6", "7", "8"]
+        self.my_turn = (self.team == "white")
+        self.ready = True # Both players are in so we are ready to start
+
+    # Puts the pieces back for a new game and forgets everything about the last one
+    def reset_board(self):
+        self.board = Board(self.square_size, self.sidebar_size, backend="bitboard")
+        self.board.fill_board()
+        for pieces in self.captured.values():
+            for sprites in pieces.values():
+                sprites.clear()
+        self.moves = []
+        self.selected_piece = None
+        self.unanswered = None
+        self.move_sent_at = None
+        self.activity_texts = self.activity_texts[:1] # Keep the heading
+        self.game_over = False
+        self.drawn = None
+
+    def start_computer_game(self):
+        self.computer = Search()
+        self.network.close() # Leave the server's waiting list
+        self.receive(("team", "white"))
+
+    # Runs on its own thread. Hands the computer's move to the game loop the same way a move from the server arrives
+    def computer_move(self, board):
+        color = "Black" if self.team == "white" else "White"
+        move, score, depth = self.computer.best_move(board, color, self.computer_time)
+        if move is None:
+            return # No legal moves, the game is already over
+        x, y, new_x, new_y, promotion = move
+        self.receive(("move", x, y, new_x, new_y))
+        if promotion is not None:
+            self.receive(("promotion", color, promotion.__name__, new_x, new_y))
+
     def get_corner_coords(self, x, y):
         return x * self.square_size + self.sidebar_size, y*self.square_size
 
@@ -370,50 +598,72 @@ class Game:
         y = coords[1] // self.square_size
         return x,y
 
-    def on_message(self,ws, incMessage):
-        if "Waiting for opponent" == incMessage:
+    def on_message(self, incMessage):
+        try:
+            message = protocol.decode(incMessage)
+        except protocol.ProtocolError as error:
+            print("ERROR: " + str(error))
+            return
+        self.receive(message)
+
+    def receive(self, message):
+        if message[0] == "heartbeat":
+            return
+        if message[0] == "waiting":
             print("Waiting...")
             return
-        if "You are team" in incMessage: # Means that both players are connected
-            self.team = incMessage.split(": ")[-1] #Grab the team this client is on
-            print("You are on team: " + self.team)
-            self.ready = True # Both players are in so we are ready to start
-            if self.team == "white":
-                self.horizontal_label = ["A","B","C","D","E","F","G","H"]
-                self.vertical_label = ["8", "7", "6", "5", "4", "3", "2", "1"]
-            else:
-                self.horizontal_label = ["H","G","F","E","D","C","B","A"]
-                self.vertical_label = ["1", "2", "3", "4", "5", "6", "7", "8"]
-            self.my_turn = (self.team == "white")
-            return 
-        if "quit" == incMessage:
+        if message[0] == "team" and not self.ready: # Means that both players are connected
+            self.start_game(message[1])
+            return
+        if message[0] == "quit":
             print("Opponent Quit!")
             return
-        while (self.messageAvailable == True):
-            pass # We need to wait for the client to read the message before overwriting it
-        self.messageAvailable = True 
-        self.message = incMessage
-
-    def on_error(self,ws,error):
-        err = str(error)
-        if err == "[Errno -2] Name or service not known": # DNS resolve error or client not connected to internet
+        if self.instruments is not None and message[0] == "move":
+            now = time.perf_counter()
+            if self.move_sent_at is not None:
+                # Includes the time the opponent took to think
+                self.instruments.record("move reply", (now - self.move_sent_at) * 1000)
+                self.move_sent_at = None
+            self.arrivals.append(now)
+        if not self.inbox.push(message):
+            print("ERROR: Too many messages waiting, dropped: " + protocol.encode_text(message))
+            if self.instruments is not None and message[0] == "move":
+                self.arrivals.pop()
+        self.wake()
+
+    # Wakes up the game loop if it is waiting for events. Safe to call from the network thread
+    def wake(self):
+        try:
+            pygame.event.post(pygame.event.Event(MESSAGE_EVENT))
+        except pygame.error:
+            pass # The display is already closed
+
+    def on_error(self, error):
+        if isinstance(error, socket.gaierror): # DNS resolve error or client not connected to internet
             print("ERROR: Please check your network, there was an error connecting to the server")
-        elif err == "[Errno 111] Connection refused": # Server did not except the request. Maybe the server is not running?
+        elif isinstance(error, ConnectionRefusedError): # Server did not except the request. Maybe the server is not running?
             print("ERROR: Had a hard time connecting to the server, contact the server admin.")
         else:
             print(error)
 
-    def on_close(self, ws):
+    def on_close(self):
         print("Connection closed!")
 
-    def on_open(self, ws):
-        def heartbeat(): # A heartbeat so the server knows the client is still alive
-            while 1:
-                try:
-                    self.ws.send("hb")
-                except websocket._exceptions.WebSocketConnectionClosedException:
-                    break
-                time.sleep(2)
-        thread.start_new_thread(heartbeat, ())
-
-game = Game()
+    # Called on the network thread once a message from send has been written to the socket
+    def on_sent(self, message):
+        now = time.perf_counter()
+        queued = self.sending.popleft()
+        try:
+            move = protocol.decode(message)[0] == "move"
+        except protocol.ProtocolError:
+            return
+        if move:
+            self.instruments.record("move send", (now - queued) * 1000)
+            self.move_sent_at = now
+
+parser = argparse.ArgumentParser(description="Online chess")
+parser.add_argument("url", nargs="?", default=SERVER_URL, help="Server to connect to")
+parser.add_argument("--stats", metavar="FILE", help="Record timings, show them with F3 and write them to FILE (.json or .csv) at exit")
+parser.add_argument("--binary", action="store_true", help="Send the compact binary messages, needs a relay.py server")
+args = parser.parse_args()
+game = Game(args.url, args.stats, args.binary)
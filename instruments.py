@@ -0,0 +1,129 @@
+import csv
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper edges of the histogram buckets: milliseconds for timings, messages for queue depths.
+# The last bucket takes everything larger
+BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+# The most recent samples of one measurement, oldest dropped first
+class Series:
+    def __init__(self, name, unit="ms", window=1000):
+        self.name = name
+        self.unit = unit
+        self.samples = deque(maxlen=window)
+        self.count = 0 # Samples ever recorded, including the ones that left the window
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    # Counts the samples in the window per bucket of BUCKETS
+    def histogram(self):
+        counts = [0] * (len(BUCKETS) + 1)
+        for value in list(self.samples):
+            for index, edge in enumerate(BUCKETS):
+                if value <= edge:
+                    break
+            else:
+                index = len(BUCKETS)
+            counts[index] += 1
+        return counts
+
+    def summary(self):
+        samples = list(self.samples)
+        return {
+            "name": self.name,
+            "unit": self.unit,
+            "count": self.count,
+            "window": len(samples),
+            "mean": sum(samples) / len(samples) if samples else 0.0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": max(samples) if samples else 0.0,
+        }
+
+
+# Opt-in timing and queue depth measurements. Nothing is recorded, and the piece classes are
+# left untouched, unless the game was started with instrumentation on
+class Instruments:
+    def __init__(self, window=1000):
+        self.window = window
+        self.series = {} # name -> Series, in the order they were first recorded
+        self.lock = threading.Lock() # The network and computer threads record too
+        self.depth = threading.local() # Per thread nesting of timed calls, see time_method
+
+    def get(self, name, unit="ms"):
+        series = self.series.get(name)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(name, Series(name, unit, self.window))
+        return series
+
+    def record(self, name, value, unit="ms"):
+        self.get(name, unit).add(value)
+
+    # Records how long the with block took, in milliseconds
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    # Replaces method on every class in classes that defines it with a version recording its
+    # run time under name. Only the outermost call is counted, so a subclass calling
+    # super().move is not recorded twice
+    def time_method(self, classes, method, name):
+        for cls in classes:
+            original = cls.__dict__.get(method)
+            if original is None:
+                continue
+            setattr(cls, method, self.timed(original, name))
+
+    def timed(self, function, name):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            depth = getattr(self.depth, name, 0)
+            if depth:
+                return function(*args, **kwargs)
+            setattr(self.depth, name, 1)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, (time.perf_counter() - start) * 1000)
+                setattr(self.depth, name, 0)
+        return timed
+
+    def summaries(self):
+        return [series.summary() for series in list(self.series.values())]
+
+    # Writes the summaries and the samples still in the window, as CSV if path ends in .csv and JSON otherwise
+    def dump(self, path):
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as file:
+                writer = csv.writer(file)
+                fields = ["name", "unit", "count", "window", "mean", "p50", "p90", "p99", "max"]
+                writer.writerow(fields)
+                for summary in self.summaries():
+                    writer.writerow([summary[field] for field in fields])
+        else:
+            with open(path, "w") as file:
+                json.dump({"summaries": self.summaries(),
+                           "samples": {name: list(series.samples) for name, series in list(self.series.items())}},
+                          file, indent=1)
+
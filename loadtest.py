@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import random
+import time
+import websockets
+import protocol
+from relay import Relay
+from validation import Referee
+
+
+# Counters shared by all the simulated players of one run
+class Results:
+    def __init__(self):
+        self.sent = 0 # Move and promotion messages sent
+        self.received = 0 # Move and promotion messages received from an opponent
+        self.heartbeats = 0
+        self.out_of_order = 0 # Received messages that do not fit the player's own copy of the game
+        self.rejected = 0 # Error replies from the relay
+        self.stalled = 0 # Games abandoned because the opponent's move never came
+        self.games = 0 # Games finished by checkmate, stalemate or the ply limit
+        self.round_trips = [] # Seconds from sending a move until the opponent's reply arrives
+
+    def percentile(self, fraction):
+        ordered = sorted(self.round_trips)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+# One headless player. It speaks the text protocol game.py sends, heartbeats included, keeps
+# its own copy of the game through a Referee and plays random legal moves from classes.py
+class SimulatedPlayer:
+    def __init__(self, url, results, generator, deadline, heartbeat=2.0, think=0.0, max_plies=200, timeout=10.0):
+        self.url = url
+        self.results = results
+        self.generator = generator
+        self.deadline = deadline # time.monotonic() after which no new game is started and no move made
+        self.heartbeat = heartbeat
+        self.think = think # Seconds to wait before answering a move
+        self.max_plies = max_plies
+        self.timeout = timeout # Seconds to wait for the opponent before giving the game up
+        self.team = None
+        self.color = None
+        self.referee = None
+        self.plies = 0
+        self.sent_at = None # When our last move went out, until the reply arrives
+
+    # Plays games one after another until the deadline
+    async def run(self):
+        while time.monotonic() < self.deadline:
+            await self.play()
+
+    async def play(self):
+        self.team = None
+        self.referee = None
+        self.plies = 0
+        self.sent_at = None
+        async with websockets.connect(self.url, compression=None, ping_interval=None) as ws:
+            beat = asyncio.ensure_future(self.beat(ws))
+            try:
+                while True:
+                    wait = self.timeout
+                    if self.team is None: # Nobody left to pair with once the others stop at the deadline
+                        wait = max(0.1, min(wait, self.deadline - time.monotonic()))
+                    try:
+                        text = await asyncio.wait_for(ws.recv(), wait)
+                    except asyncio.TimeoutError:
+                        if self.team is not None:
+                            self.results.stalled += 1
+                        await ws.send("quit")
+                        return
+                    if not await self.receive(ws, text):
+                        return
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            finally:
+                beat.cancel()
+
+    async def beat(self, ws):
+        while True:
+            await ws.send("hb")
+            self.results.heartbeats += 1
+            await asyncio.sleep(self.heartbeat)
+
+    # Handles one message, returns False once the game is over
+    async def receive(self, ws, text):
+        message = protocol.decode_text(text)
+        kind = message[0]
+        if kind == "team":
+            self.team = message[1]
+            self.color = "White" if self.team == "white" else "Black"
+            self.referee = Referee()
+            if self.team == "white":
+                return await self.move(ws)
+        elif kind == "quit":
+            return False
+        elif kind == "error":
+            self.results.rejected += 1
+        elif kind in ("move", "promotion"):
+            if kind == "move" and self.sent_at is not None:
+                self.results.round_trips.append(time.perf_counter() - self.sent_at)
+                self.sent_at = None
+            self.results.received += 1
+            if self.referee.check("black" if self.team == "white" else "white", message) is not None:
+                self.results.out_of_order += 1
+                return True
+            if self.referee.promotion is not None:
+                return True # The promotion piece follows
+            self.plies += 1
+            if self.referee.result is None and self.referee.board.turn == self.color:
+                if self.think:
+                    await asyncio.sleep(self.think)
+                return await self.move(ws)
+        return True
+
+    # Plays a random legal move, or ends the game if it is over or time is up
+    async def move(self, ws):
+        board = self.referee.board
+        if time.monotonic() >= self.deadline or self.plies >= self.max_plies:
+            await ws.send("quit")
+            self.results.games += self.plies >= self.max_plies
+            return False
+        piece, target, promotion = self.generator.choice(board.get_moves(self.color))
+        messages = [("move", piece.x, piece.y, target[0], target[1])]
+        if promotion is not None:
+            messages.append(("promotion", self.color, promotion.__name__, target[0], target[1]))
+        self.sent_at = time.perf_counter()
+        for message in messages:
+            self.referee.check(self.team, message)
+            await ws.send(protocol.encode_text(message))
+            self.results.sent += 1
+        self.plies += 1
+        if self.referee.result is not None:
+            await ws.send("quit") # The relay forwards the last move before acting on the quit
+            self.results.games += 1
+            return False
+        return True
+
+
+async def load_test(players, duration, url=None, port=8770, seed=1, **options):
+    relay = None
+    server = None
+    if url is None:
+        relay = Relay()
+        server = await websockets.serve(relay.handle, "localhost", port, compression=None, ping_interval=None)
+        url = "ws://localhost:%d" % port
+    results = Results()
+    generator = random.Random(seed)
+    deadline = time.monotonic() + duration
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[SimulatedPlayer(url, results, random.Random(generator.random()), deadline, **options).run()
+                               for player in range(players)])
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+    return results, time.perf_counter() - start, relay
+
+
+def report(results, elapsed, relay):
+    dropped = results.sent - results.received
+    print("%d games, %d moves sent, %d received, %d heartbeats in %.2fs"
+          % (results.games, results.sent, results.received, results.heartbeats, elapsed))
+    print("%.0f messages/s (%.0f moves/s)" % ((results.sent + results.heartbeats) / elapsed, results.received / elapsed))
+    if results.round_trips:
+        print("Move round trip  p50 %.2fms  p90 %.2fms  p99 %.2fms  max %.2fms"
+              % tuple(1000 * value for value in (results.percentile(0.5), results.percentile(0.9),
+                                                 results.percentile(0.99), max(results.round_trips))))
+    print("Dropped %d  out of order %d  rejected %d  stalled games %d"
+          % (dropped, results.out_of_order, results.rejected, results.stalled))
+    if relay is not None:
+        print("Relay", relay.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays random games between simulated players through a local relay")
+    parser.add_argument("players", nargs="?", type=int, default=100, help="Number of simulated players, two per game")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to keep starting games and making moves")
+    parser.add_argument("--url", help="Relay to connect to, by default one is started in this process")
+    parser.add_argument("--port", type=int, default=8770, help="Port for the relay started in this process")
+    parser.add_argument("--heartbeat", type=float, default=2.0, help="Seconds between heartbeats")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds each player waits before answering a move")
+    parser.add_argument("--plies", type=int, default=200, help="Moves after which a game is ended")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.players % 2:
+        parser.error("players must be even, the relay pairs them up")
+    outcome = asyncio.run(load_test(args.players, args.duration, args.url, args.port, args.seed,
+                                    heartbeat=args.heartbeat, think=args.think, max_plies=args.plies))
+    report(*outcome)
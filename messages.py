@@ -0,0 +1,59 @@
+import queue
+import threading
+
+
+# Thread safe, bounded queue of incoming messages. The network thread pushes without ever
+# waiting and the game loop drains a batch each frame. When the game falls so far behind that
+# the queue is full, new messages are refused and counted rather than blocking the network thread
+class MessageQueue:
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.messages = queue.Queue(capacity)
+        self.lock = threading.Lock() # Guards the counters, which both threads update
+        self.pushed = 0 # Messages accepted
+        self.dropped = 0 # Messages refused because the queue was full
+        self.drained = 0 # Messages handed to the game loop
+        self.batches = 0 # Non empty drains
+        self.high_water = 0 # Most messages ever waiting at once
+
+    # Adds a message without blocking. Returns False if the queue was full and the message was dropped
+    def push(self, message):
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        with self.lock:
+            self.pushed += 1
+            self.high_water = max(self.high_water, self.messages.qsize())
+        return True
+
+    # Takes up to limit waiting messages, oldest first
+    def drain(self, limit=None):
+        batch = []
+        while limit is None or len(batch) < limit:
+            try:
+                batch.append(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            with self.lock:
+                self.drained += len(batch)
+                self.batches += 1
+        return batch
+
+    def __len__(self):
+        return self.messages.qsize()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "waiting": self.messages.qsize(),
+                "capacity": self.capacity,
+                "pushed": self.pushed,
+                "dropped": self.dropped,
+                "drained": self.drained,
+                "batches": self.batches,
+                "high_water": self.high_water,
+            }
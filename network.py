@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import websockets
+
+# Close codes that mean the other side hung up on purpose rather than the connection dropping
+# (1005 is what a close without a code, like server.js sends, arrives as)
+DELIBERATE_CLOSE_CODES = (1000, 1005)
+
+
+# An asyncio event loop running in a daemon thread. Any number of clients can share one,
+# so a process running many games still only needs a single network thread
+class EventLoopThread:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="network", daemon=True)
+        self.thread.start()
+
+    # Schedules a coroutine on the loop from any thread and returns its concurrent.futures.Future
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Calls a function on the loop thread
+    def call(self, function, *args):
+        self.loop.call_soon_threadsafe(function, *args)
+
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+def shared_loop():
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoopThread()
+        return _shared_loop
+
+
+# Websocket client that owns the connection, the heartbeat, reconnecting with exponential
+# backoff after a connection error and an outbound queue, all on one asyncio loop. Its
+# methods never block, so the game loop can call them every frame. The callbacks run on
+# the network thread: on_message(text), on_open(), on_close(), on_error(exception) and
+# on_sent(message) once a queued message has been written to the connection
+class Client:
+    def __init__(self, url, on_message, on_open=None, on_close=None, on_error=None,
+                 heartbeat=2.0, min_backoff=1.0, max_backoff=30.0, loop=None, heartbeat_message="hb",
+                 on_sent=None):
+        self.url = url
+        self.on_message = on_message
+        self.on_open = on_open
+        self.on_close = on_close
+        self.on_error = on_error
+        self.on_sent = on_sent
+        self.heartbeat = heartbeat # Seconds between heartbeat messages so the server knows the client is still alive
+        self.heartbeat_message = heartbeat_message
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.loop = loop or shared_loop()
+        self.outbox = None # asyncio.Queue of messages to send, created on the loop
+        self.unsent = None # A message whose send failed, sent first after reconnecting
+        self.ws = None # The open connection
+        self.connected = False
+        self.closing = False
+        self.task = None
+
+    def start(self):
+        self.task = self.loop.submit(self.run())
+
+    # Queues a message to send. Messages sent while disconnected go out once the connection is back
+    def send(self, message):
+        self.loop.call(self.queue, message)
+
+    def queue(self, message):
+        if self.outbox is None:
+            self.outbox = asyncio.Queue()
+        self.outbox.put_nowait(message)
+
+    # Stops reconnecting and closes the connection once the queued messages are sent.
+    # Waits up to timeout seconds for that to finish, or returns straight away if timeout is None
+    def close(self, timeout=None):
+        future = self.loop.submit(self.shutdown())
+        if timeout is not None:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+    async def shutdown(self):
+        self.closing = True
+        if self.connected and self.outbox is not None:
+            try:
+                await asyncio.wait_for(self.outbox.join(), self.heartbeat * 2)
+            except asyncio.TimeoutError:
+                pass
+        if self.ws is not None:
+            await self.ws.close() # run sees the connection end and stops
+        elif self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        if self.outbox is None:
+            self.outbox = asyncio.Queue()
+        backoff = self.min_backoff
+        while not self.closing:
+            ws = None
+            try:
+                async with websockets.connect(self.url) as ws:
+                    self.ws = ws
+                    self.connected = True
+                    backoff = self.min_backoff
+                    if self.on_open is not None:
+                        self.on_open()
+                    tasks = [asyncio.ensure_future(coroutine)
+                             for coroutine in (self.read(ws), self.write(ws), self.beat(ws))]
+                    try:
+                        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+                    for task in done:
+                        task.result() # Raises the error that ended the connection, if any
+            except asyncio.CancelledError:
+                break
+            except websockets.exceptions.ConnectionClosed:
+                pass # Whether to reconnect depends on the close code below
+            except (OSError, websockets.exceptions.WebSocketException) as error:
+                if self.on_error is not None and not self.closing:
+                    self.on_error(error)
+            finally:
+                self.ws = None
+                if self.connected:
+                    self.connected = False
+                    if self.on_close is not None:
+                        self.on_close()
+            if ws is not None and ws.close_code in DELIBERATE_CLOSE_CODES:
+                self.closing = True # The server ended the connection on purpose, don't come back
+            if self.closing:
+                break
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def read(self, ws):
+        async for message in ws:
+            self.on_message(message)
+
+    async def write(self, ws):
+        while True:
+            if self.unsent is None:
+                self.unsent = await self.outbox.get()
+            await ws.send(self.unsent)
+            if self.on_sent is not None:
+                self.on_sent(self.unsent)
+            self.unsent = None
+            self.outbox.task_done()
+
+    async def beat(self, ws):
+        while True:
+            await ws.send(self.heartbeat_message)
+            await asyncio.sleep(self.heartbeat)
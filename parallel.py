@@ -0,0 +1,170 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from classes import Board
+from search import Search, TranspositionTable, PROMOTIONS, MATE, in_check
+
+SHARE_DEPTH = 2 # Only entries searched at least this deep are passed between processes
+
+
+# Transposition table that remembers the deep entries written since they were last taken,
+# so a worker can send them back to be merged with the other workers' tables
+class SharedTable(TranspositionTable):
+    def __init__(self, size=1 << 18):
+        super().__init__(size)
+        self.fresh = []
+
+    def put(self, key, depth, score, flag, move, ply=0):
+        super().put(key, depth, score, flag, move, ply)
+        if depth >= SHARE_DEPTH:
+            self.fresh.append((key, self.entries[key])) # As stored, mate scores already converted
+
+    def take(self):
+        fresh = self.fresh
+        self.fresh = []
+        return fresh
+
+
+# Per process state of a pool worker
+_search = None
+_generation = None
+_fen = None
+_board = None
+
+
+def _start_worker(table_size):
+    global _search
+    _search = Search(table_size)
+    _search.table = SharedTable(table_size)
+
+
+# Runs in a worker: searches some of the root moves and returns the result, the node count
+# and the new deep table entries
+def _search_moves(generation, fen, color, keys, depth, time_limit, alpha, entries):
+    global _generation, _fen, _board
+    if generation != _generation:
+        _search.table.clear() # A different game, the old entries are no use
+        _generation = generation
+    if fen != _fen:
+        _board = Board.from_fen(fen, backend="bitboard")
+        _fen = fen
+    _search.table.merge(entries)
+    moves = [(_board.get_space(x, y), (new_x, new_y), promotion) for x, y, new_x, new_y, promotion in keys]
+    result = _search.search_moves(_board, color, moves, depth, time_limit, alpha)
+    return result, _search.nodes, _search.table.take()
+
+
+# Iterative deepening search that splits the root moves between a pool of processes.
+# Every depth the best move so far is searched first to get a score to beat, then the
+# other moves are dealt out round robin and each worker searches its share against that
+# score with its own table. The deep entries the workers find are merged and handed to
+# all of them with the next search
+class ParallelSearch:
+    def __init__(self, workers=None, table_size=1 << 18):
+        self.workers = workers or os.cpu_count() or 1
+        self.table_size = table_size
+        self.pool = None
+        self.generation = 0
+        self.nodes = 0
+
+    # Forgets everything learned so far, for example when a new game starts. The workers clear
+    # their tables when they see the new generation
+    def clear(self):
+        self.generation += 1
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    # Same interface and result as Search.best_move
+    def best_move(self, board, color, time_limit=2.0, max_depth=64):
+        deadline = time.perf_counter() + time_limit
+        self.nodes = 0
+        moves = board.get_moves(color, PROMOTIONS)
+        if not moves:
+            return None, -MATE if in_check(board, color) else 0, 0
+        keys = [Search.key(move) for move in moves]
+        best = (keys[0], 0, 0)
+        if len(keys) == 1:
+            return best
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=_start_worker, initargs=(self.table_size,))
+        fen = board.fen() # The position is sent to the workers as FEN
+        entries = []
+        scores = {}
+        for depth in range(1, max_depth + 1):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            # Best moves of the last depth first, so each worker starts on a strong candidate
+            keys.sort(key=lambda key: -scores.get(key, -MATE * 2))
+            first, entries = self.run(fen, color, [[keys[0]]], depth, remaining, -MATE * 2, entries)
+            if None in first:
+                break # Out of time part way through this depth
+            chunks = [keys[1 + i::self.workers] for i in range(min(self.workers, len(keys) - 1))]
+            results, entries = self.run(fen, color, chunks, depth, deadline - time.perf_counter(), first[0][1], entries)
+            if None in results:
+                break
+            move, score = first[0]
+            for result in results:
+                if result[1] > score:
+                    move, score = result
+            scores = {move: score}
+            best = (move, score, depth)
+            if score >= MATE - depth or score <= -MATE + depth:
+                break
+        return best
+
+    # Searches each list of moves in a worker. Returns the results and the deep table entries found
+    def run(self, fen, color, chunks, depth, time_limit, alpha, entries):
+        futures = [self.pool.submit(_search_moves, self.generation, fen, color, chunk, depth, time_limit, alpha, entries)
+                   for chunk in chunks]
+        found = []
+        results = []
+        for future in futures:
+            result, nodes, fresh = future.result()
+            self.nodes += nodes
+            found.extend(fresh)
+            results.append(result)
+        return results, found
+
+
+# Times a fixed depth search of each perft position with one process and with the pool
+def benchmark(depth, workers):
+    import perft
+    parallel = ParallelSearch(workers)
+    total_single = 0
+    total_parallel = 0
+    try:
+        for name, fen, counts in perft.POSITIONS:
+            board, color = perft.setup_board(fen, "bitboard")
+            single = Search()
+            start = time.perf_counter()
+            single_move = single.best_move(board, color, float("inf"), depth)
+            single_time = time.perf_counter() - start
+            parallel.clear()
+            start = time.perf_counter()
+            parallel_move = parallel.best_move(board, color, float("inf"), depth)
+            parallel_time = time.perf_counter() - start
+            total_single += single_time
+            total_parallel += parallel_time
+            print("%-10s depth %d  single %8.2fs %8d nodes  %s  parallel %8.2fs %8d nodes  %s  speedup %5.2fx"
+                  % (name, depth, single_time, single.nodes, perft.move_name(single_move[0][:2], single_move[0][2:4]),
+                     parallel_time, parallel.nodes, perft.move_name(parallel_move[0][:2], parallel_move[0][2:4]),
+                     single_time / parallel_time))
+    finally:
+        parallel.close()
+    print("Total %d workers: single %.2fs  parallel %.2fs  speedup %.2fx"
+          % (parallel.workers, total_single, total_parallel, total_single / total_parallel))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the single process search with the process pool search")
+    parser.add_argument("depth", nargs="?", type=int, default=4)
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of processes, defaults to the number of cores")
+    args = parser.parse_args()
+    if args.depth < 1:
+        parser.error("depth must be at least 1")
+    benchmark(args.depth, args.workers)
@@ -0,0 +1,158 @@
+import argparse
+import sys
+import time
+from classes import Board, Pawn, Knight, Bishop, Rook, Queen, King
+from bitboard import Position, WHITE, BLACK
+
+# Standard perft positions and their known leaf counts for depth 1, 2, 3...
+POSITIONS = (
+    ("Initial", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     (20, 400, 8902, 197281, 4865609, 119060324)),
+    ("Kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     (48, 2039, 97862, 4085603, 193690690)),
+    ("Position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     (14, 191, 2812, 43238, 674624, 11030083)),
+    ("Position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     (6, 264, 9467, 422333, 15833292)),
+    ("Position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     (44, 1486, 62379, 2103487, 89941194)),
+    ("Position 6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     (46, 2079, 89890, 3894594, 164075551)),
+)
+
+# FEN letters in the order of the bitboard piece kinds
+LETTERS = "pnbrqk"
+PIECE_CLASSES = (Pawn, Knight, Bishop, Rook, Queen, King)
+
+
+# Sets up a Board from a FEN string. Returns the board and the color to move
+def setup_board(fen, backend, attack_maps="incremental"):
+    board = Board.from_fen(fen, backend=backend, attack_maps=attack_maps)
+    return board, board.turn
+
+
+# Builds a bitboard Position from a FEN string
+def setup_position(fen):
+    placement, side, castling, en_passant = fen.split()[:4]
+    position = Position()
+    for y, row in enumerate(placement.split("/")):
+        x = 0
+        for char in row:
+            if char.isdigit():
+                x += int(char)
+                continue
+            position.put(y * 8 + x, WHITE if char.isupper() else BLACK, LETTERS.index(char.lower()))
+            x += 1
+    position.turn = WHITE if side == "w" else BLACK
+    for char, right in zip("KQkq", (1, 2, 4, 8)):
+        if char in castling:
+            position.castling |= right
+    if en_passant != "-":
+        position.ep = (8 - int(en_passant[1])) * 8 + ord(en_passant[0]) - 97
+    return position
+
+
+# Counts the leaf nodes depth moves deep using the Board API (get_valid_moves and make_move/unmake_move)
+def perft_board(board, color, depth):
+    moves = board.get_moves(color)
+    if depth == 1:
+        return len(moves)
+    other = "Black" if color == "White" else "White"
+    nodes = 0
+    for piece, target, promotion in moves:
+        board.make_move(piece, *target, promotion)
+        nodes += perft_board(board, other, depth - 1)
+        board.unmake_move()
+    return nodes
+
+
+# Counts the leaf nodes depth moves deep directly on a bitboard Position
+def perft_position(position, depth):
+    moves = position.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        undo = position.make_move(move)
+        nodes += perft_position(position, depth - 1)
+        position.unmake_move(undo)
+    return nodes
+
+
+def move_name(frm, to, promotion=""):
+    return "%s%d%s%d%s" % (chr(97 + frm[0]), 8 - frm[1], chr(97 + to[0]), 8 - to[1], promotion)
+
+
+# Prints the node count below each root move, used to narrow down a wrong total
+def divide(fen, depth, backend, attack_maps="incremental"):
+    total = 0
+    if backend == "position":
+        position = setup_position(fen)
+        for move in position.legal_moves():
+            undo = position.make_move(move)
+            nodes = perft_position(position, depth - 1) if depth > 1 else 1
+            position.unmake_move(undo)
+            frm = move & 63
+            to = (move >> 6) & 63
+            promotion = LETTERS[move >> 12] if move >> 12 else ""
+            print("%s: %d" % (move_name((frm & 7, frm >> 3), (to & 7, to >> 3), promotion), nodes))
+            total += nodes
+    else:
+        board, color = setup_board(fen, backend, attack_maps)
+        other = "Black" if color == "White" else "White"
+        for piece, target, promotion in board.get_moves(color):
+            origin = (piece.x, piece.y)
+            board.make_move(piece, *target, promotion)
+            nodes = perft_board(board, other, depth - 1) if depth > 1 else 1
+            board.unmake_move()
+            name = "" if promotion is None else LETTERS[PIECE_CLASSES.index(promotion)]
+            print("%s: %d" % (move_name(origin, target, name), nodes))
+            total += nodes
+    print("Total: %d" % total)
+    return total
+
+
+def run(depth, backend, names=None, attack_maps="incremental"):
+    passed = True
+    for name, fen, counts in POSITIONS:
+        if names and not any(wanted.lower() in name.lower() for wanted in names):
+            continue
+        start = time.perf_counter()
+        if backend == "position":
+            nodes = perft_position(setup_position(fen), depth)
+        else:
+            board, color = setup_board(fen, backend, attack_maps)
+            nodes = perft_board(board, color, depth)
+        elapsed = time.perf_counter() - start
+        expected = counts[depth - 1] if depth <= len(counts) else None
+        if expected is None:
+            result = "??"
+        elif nodes == expected:
+            result = "OK"
+        else:
+            result = "FAIL"
+            passed = False
+        print("%-10s depth %d  nodes %10d  expected %10s  %-4s  %8.2fs  %10.0f nodes/s"
+              % (name, depth, nodes, expected, result, elapsed, nodes / max(elapsed, 1e-9)))
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Counts move generation leaf nodes and compares them to known perft results")
+    parser.add_argument("depth", nargs="?", type=int, default=3)
+    parser.add_argument("-b", "--backend", choices=("objects", "bitboard", "position"), default="bitboard",
+                        help="Board backend to walk through get_valid_moves/make_move, or position for the raw bitboard Position")
+    parser.add_argument("-p", "--position", action="append", help="Only run positions whose name contains this text")
+    parser.add_argument("--attack-maps", choices=("incremental", "vectorized"), default="incremental",
+                        help="How the objects backend keeps its attack maps up to date")
+    parser.add_argument("--divide", action="store_true", help="Print the count below each root move of the selected positions")
+    args = parser.parse_args()
+    if args.depth < 1:
+        parser.error("depth must be at least 1")
+    if args.divide:
+        for name, fen, counts in POSITIONS:
+            if not args.position or any(wanted.lower() in name.lower() for wanted in args.position):
+                print(name)
+                divide(fen, args.depth, args.backend, args.attack_maps)
+    elif not run(args.depth, args.backend, args.position, args.attack_maps):
+        sys.exit(1)
@@ -0,0 +1,129 @@
+import struct
+
+# Messages are tuples whose first item is the kind:
+#   ("heartbeat",)                        "hb"
+#   ("quit",)                             "quit"
+#   ("waiting",)                          "Waiting for opponent"
+#   ("team", "white" or "black")          "Connected to opponent You are team: white"
+#   ("move", x, y, new_x, new_y)          "e6 e4" (file letter from x, then the board row y)
+#   ("promotion", color, name, x, y)      "White Queen 3 0"
+#   ("error", text)                       "error: text"
+# Binary messages start with one byte holding the protocol version in the high four bits
+# and the kind in the low four. Moves and promotions take three bytes in total, the
+# control messages one or two. The text forms are the ones server.js relays.
+
+VERSION = 1
+KINDS = ("heartbeat", "quit", "waiting", "team", "move", "promotion", "error")
+COLORS = ("White", "Black")
+TEAMS = ("white", "black")
+PROMOTIONS = ("Queen", "Rook", "Bishop", "Knight")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode(message):
+    kind = KINDS.index(message[0])
+    header = VERSION << 4 | kind
+    if message[0] == "team":
+        return struct.pack("BB", header, TEAMS.index(message[1]))
+    if message[0] == "move":
+        x, y, new_x, new_y = message[1:]
+        return struct.pack("BBB", header, y * 8 + x, new_y * 8 + new_x)
+    if message[0] == "promotion":
+        color, name, x, y = message[1:]
+        return struct.pack("BBB", header, COLORS.index(color) << 2 | PROMOTIONS.index(name), y * 8 + x)
+    if message[0] == "error":
+        return bytes((header,)) + message[1].encode("utf-8")
+    return bytes((header,))
+
+
+def decode_binary(data):
+    if not data:
+        raise ProtocolError("Empty message")
+    version = data[0] >> 4
+    kind = data[0] & 15
+    if version != VERSION:
+        raise ProtocolError("Unsupported protocol version %d" % version)
+    if kind >= len(KINDS):
+        raise ProtocolError("Unknown message kind %d" % kind)
+    kind = KINDS[kind]
+    if kind == "error":
+        return kind, data[1:].decode("utf-8", "replace")
+    size = {"team": 2, "move": 3, "promotion": 3}.get(kind, 1)
+    if len(data) != size:
+        raise ProtocolError("A %s message is %d bytes, got %d" % (kind, size, len(data)))
+    if kind == "team":
+        if data[1] >= len(TEAMS):
+            raise ProtocolError("Unknown team %d" % data[1])
+        return kind, TEAMS[data[1]]
+    if kind == "move":
+        if data[1] > 63 or data[2] > 63:
+            raise ProtocolError("Square out of range")
+        return kind, data[1] & 7, data[1] >> 3, data[2] & 7, data[2] >> 3
+    if kind == "promotion":
+        if data[1] >> 2 > 1 or data[2] > 63:
+            raise ProtocolError("Bad promotion")
+        return kind, COLORS[data[1] >> 2], PROMOTIONS[data[1] & 3], data[2] & 7, data[2] >> 3
+    return (kind,)
+
+
+def encode_text(message):
+    kind = message[0]
+    if kind == "heartbeat":
+        return "hb"
+    if kind == "quit":
+        return "quit"
+    if kind == "waiting":
+        return "Waiting for opponent"
+    if kind == "team":
+        return "Connected to opponent You are team: " + message[1]
+    if kind == "move":
+        x, y, new_x, new_y = message[1:]
+        return chr(x + 97) + str(y) + " " + chr(new_x + 97) + str(new_y)
+    if kind == "promotion":
+        color, name, x, y = message[1:]
+        return color + " " + name + " " + str(x) + " " + str(y)
+    if kind == "error":
+        return "error: " + message[1]
+    raise ProtocolError("Unknown message kind %r" % (kind,))
+
+
+def decode_text(text):
+    if text == "hb":
+        return ("heartbeat",)
+    if text == "quit":
+        return ("quit",)
+    if text == "Waiting for opponent":
+        return ("waiting",)
+    if "You are team: " in text:
+        team = text.split(": ")[-1]
+        if team not in TEAMS:
+            raise ProtocolError("Unknown team %r" % team)
+        return "team", team
+    if text.startswith("error: "):
+        return "error", text[7:]
+    if text.startswith("Sorry"): # server.js turning a third player away
+        return "error", text
+    words = text.split()
+    if len(words) == 2 and len(words[0]) == 2 and len(words[1]) == 2:
+        squares = []
+        for word in words:
+            x = ord(word[0]) - 97
+            if not (0 <= x < 8 and "0" <= word[1] <= "7"):
+                raise ProtocolError("Bad move %r" % text)
+            squares += [x, int(word[1])]
+        return ("move",) + tuple(squares)
+    if len(words) == 4 and words[0] in COLORS and words[1] in PROMOTIONS:
+        if not (words[2] in "01234567" and words[3] in "01234567" and len(words[2]) == len(words[3]) == 1):
+            raise ProtocolError("Bad promotion %r" % text)
+        return "promotion", words[0], words[1], int(words[2]), int(words[3])
+    raise ProtocolError("Unknown message %r" % text)
+
+
+# Decodes either form: text messages arrive as str and binary ones as bytes
+def decode(data):
+    if isinstance(data, str):
+        return decode_text(data)
+    return decode_binary(bytes(data))
@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import time
+import websockets
+import protocol
+from validation import Referee
+
+# Control messages the relay acts on, in both protocol forms
+HEARTBEATS = ("hb", protocol.encode(("heartbeat",)))
+QUITS = ("quit", protocol.encode(("quit",)))
+
+
+class Player:
+    def __init__(self, ws):
+        self.ws = ws
+        self.room = None
+        self.opponent = None
+        self.team = None
+        self.last_alive = time.monotonic()
+
+
+# The two players of one game
+class Room:
+    def __init__(self, number, white, black, referee=None):
+        self.number = number
+        self.white = white
+        self.black = black
+        self.referee = referee # Checks the moves before they are forwarded, None to trust the players
+
+
+# Websocket relay speaking the same protocol as server.js, but for any number of games.
+# Players are paired into rooms in the order they connect: the first of a pair is told
+# "Waiting for opponent", and once the second arrives each hears which team it is. After
+# that every message goes straight to the player's opponent; heartbeats only keep the
+# player alive, and "quit", a disconnect or a missed heartbeat ends the game for both.
+# With validate set, each room keeps its own board and a move that is not legal is
+# answered with an error message to its sender instead of being forwarded.
+class Relay:
+    def __init__(self, timeout=10.0, validate=True):
+        self.timeout = timeout # Seconds without a heartbeat before a player is dropped
+        self.validate = validate
+        self.waiting = None # Player waiting to be paired
+        self.players = set()
+        self.rooms = {} # Room number -> Room
+        self.next_room = 0
+        self.relayed = 0
+        self.rejected = 0
+        self.games = 0
+
+    async def handle(self, ws):
+        player = Player(ws)
+        self.players.add(player)
+        try:
+            await self.join(player)
+            async for message in ws:
+                await self.receive(player, message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.players.discard(player)
+            await self.leave(player)
+
+    async def join(self, player):
+        if self.waiting is None:
+            self.waiting = player
+            await player.ws.send("Waiting for opponent")
+            return
+        white = self.waiting
+        self.waiting = None
+        room = Room(self.next_room, white, player, Referee() if self.validate else None)
+        self.next_room += 1
+        self.rooms[room.number] = room
+        self.games += 1
+        for team, member, opponent in (("white", white, player), ("black", player, white)):
+            member.room = room
+            member.team = team
+            member.opponent = opponent
+            member.last_alive = time.monotonic()
+        await player.ws.send("Connected to opponent You are team: black")
+        await self.send(white, "Connected to opponent You are team: white")
+
+    async def receive(self, player, message):
+        if message in HEARTBEATS:
+            player.last_alive = time.monotonic()
+        elif message in QUITS:
+            await self.end(player)
+        elif player.opponent is not None:
+            await self.forward(player, message)
+
+    async def forward(self, player, message):
+        referee = player.room.referee
+        if referee is not None:
+            try:
+                error = referee.check(player.team, protocol.decode(message))
+            except protocol.ProtocolError as problem:
+                error = str(problem)
+            if error is not None:
+                self.rejected += 1
+                reply = ("error", error)
+                await self.send(player, protocol.encode(reply) if isinstance(message, bytes) else protocol.encode_text(reply))
+                return
+        self.relayed += 1
+        await self.send(player.opponent, message)
+
+    async def send(self, player, message):
+        try:
+            await player.ws.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass # Its own handler cleans up
+
+    # Tells the opponent the game is over and disconnects both players
+    async def end(self, player):
+        opponent = player.opponent
+        self.close_room(player.room)
+        if opponent is not None:
+            await self.send(opponent, "quit")
+            await opponent.ws.close()
+        await player.ws.close()
+
+    def close_room(self, room):
+        if room is None or self.rooms.pop(room.number, None) is None:
+            return
+        for member in (room.white, room.black):
+            member.room = None
+            member.opponent = None
+
+    async def leave(self, player):
+        if self.waiting is player:
+            self.waiting = None
+        if player.room is not None:
+            await self.end(player)
+
+    # Drops players whose heartbeats stopped, checking every half timeout
+    async def watch_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.timeout / 2)
+            now = time.monotonic()
+            for player in [player for player in self.players if now - player.last_alive >= self.timeout]:
+                print("Player in room %s lost connection" % (player.room.number if player.room else "-"))
+                await self.leave(player)
+                await player.ws.close()
+
+    def stats(self):
+        return {"players": len(self.players), "rooms": len(self.rooms), "games": self.games,
+                "relayed": self.relayed, "rejected": self.rejected}
+
+    async def serve(self, host, port, report=0):
+        async with websockets.serve(self.handle, host, port, compression=None, ping_interval=None):
+            watcher = asyncio.ensure_future(self.watch_heartbeats())
+            try:
+                while True:
+                    await asyncio.sleep(report or 3600)
+                    if report:
+                        print(self.stats(), flush=True)
+            finally:
+                watcher.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relays moves between pairs of players, like server.js but for many games at once")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=10.0, help="Seconds without a heartbeat before a player is dropped")
+    parser.add_argument("--trust", action="store_true", help="Forward moves without checking them against the rules")
+    parser.add_argument("--report", type=float, default=0, help="Print player, room and message counts every this many seconds")
+    args = parser.parse_args()
+    print("Relaying on ws://%s:%d" % (args.host, args.port))
+    try:
+        asyncio.run(Relay(args.timeout, not args.trust).serve(args.host, args.port, args.report))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,82 @@
+import argparse
+import random
+import time
+from bitboard import Position, QUEEN, ROOK, BISHOP, KNIGHT
+from classes import Board, Queen, Rook, Bishop, Knight
+
+PROMOTION_CLASSES = {QUEEN: Queen, ROOK: Rook, BISHOP: Bishop, KNIGHT: Knight}
+
+
+# The piece lists as they were before PieceList: a list scanned for the piece's square on removal
+# and filtered by name for each type, kept to compare the per move cost against
+class PlainPieceList(list):
+    def of_type(self, name):
+        return [piece for piece in self if piece.name == name]
+
+    def remove(self, piece):
+        for i in range(len(self)):
+            if self[i].x == piece.x and self[i].y == piece.y:
+                self.pop(i)
+                return i
+        return None
+
+
+class PlainListBoard(Board):
+    piece_list = PlainPieceList
+
+
+# Plays random legal games on a bitboard Position and returns each as a list of packed moves
+def random_games(count, seed, max_plies=200):
+    generator = random.Random(seed)
+    games = []
+    for game in range(count):
+        position = Position.initial()
+        moves = []
+        while len(moves) < max_plies:
+            legal = position.legal_moves()
+            if not legal:
+                break
+            move = generator.choice(legal)
+            position.make_move(move)
+            moves.append(move)
+        games.append(moves)
+    return games
+
+
+# Replays each game on a Board with make_move, then takes it all back with unmake_move.
+# Returns the seconds spent making and unmaking moves, and the number of moves
+def replay(games, backend="objects", board_class=Board):
+    forward = 0.0
+    backward = 0.0
+    plies = 0
+    for moves in games:
+        board = board_class(100, 250, backend=backend)
+        board.fill_board()
+        start = time.perf_counter()
+        for move in moves:
+            frm = move & 63
+            to = move >> 6 & 63
+            board.make_move(board.get_space(frm & 7, frm >> 3), to & 7, to >> 3, PROMOTION_CLASSES.get(move >> 12))
+        middle = time.perf_counter()
+        for move in moves:
+            board.unmake_move()
+        forward += middle - start
+        backward += time.perf_counter() - middle
+        plies += len(moves)
+    return forward, backward, plies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the cost per move of make_move and unmake_move over replayed random games")
+    parser.add_argument("games", nargs="?", type=int, default=1000)
+    parser.add_argument("--backend", choices=("objects", "bitboard"), default="objects")
+    parser.add_argument("--plies", type=int, default=200, help="Moves after which a game is cut short")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--pieces", choices=("indexed", "list"), default="indexed",
+                        help="Keep the pieces in the indexed PieceList or in the plain lists used before it")
+    args = parser.parse_args()
+    games = random_games(args.games, args.seed, args.plies)
+    forward, backward, plies = replay(games, args.backend, PlainListBoard if args.pieces == "list" else Board)
+    print("%d games, %d moves" % (len(games), plies))
+    print("make_move    %8.2fs %8.1fus per move" % (forward, forward / plies * 1e6))
+    print("unmake_move  %8.2fs %8.1fus per move" % (backward, backward / plies * 1e6))
@@ -0,0 +1,264 @@
+import time
+from classes import Queen, Knight
+
+MATE = 100000
+INFINITY = 1000000
+VALUES = {"Pawn": 100, "Knight": 320, "Bishop": 330, "Rook": 500, "Queen": 900, "King": 20000}
+# The computer only considers the promotions that are ever worth playing
+PROMOTIONS = (Queen, Knight)
+# Bonus for standing near the middle of the board, indexed [y][x]
+CENTER = tuple(tuple(int(7 - abs(3.5 - x) - abs(3.5 - y)) for x in range(8)) for y in range(8))
+CENTER_WEIGHTS = {"Pawn": 2, "Knight": 5, "Bishop": 3, "Rook": 1, "Queen": 1, "King": -3}
+MAX_QUIESCENCE = 6 # How many captures deep the quiescence search follows
+MATED = MATE - 1000 # Scores beyond this are mates, counted in plies from the root
+
+EXACT = 0
+LOWER = 1 # The score is at least the stored value
+UPPER = 2 # The score is at most the stored value
+
+
+class TimeUp(Exception):
+    pass
+
+
+# Transposition table keyed by Board.hash. Holds at most size entries, dropping the oldest when full.
+# Mate scores are stored counted from the entry's own position rather than the root, so put and get
+# take the ply the position was reached at and convert them
+class TranspositionTable:
+    def __init__(self, size=1 << 18):
+        self.size = size
+        self.entries = {}
+
+    def get(self, key, ply=0):
+        entry = self.entries.get(key)
+        if entry is None or not ply or abs(entry[1]) < MATED:
+            return entry
+        depth, score, flag, move = entry
+        return depth, score - ply if score > 0 else score + ply, flag, move
+
+    def put(self, key, depth, score, flag, move, ply=0):
+        entries = self.entries
+        if key not in entries and len(entries) >= self.size:
+            del entries[next(iter(entries))]
+        if abs(score) >= MATED:
+            score = score + ply if score > 0 else score - ply
+        entries[key] = (depth, score, flag, move)
+
+    def clear(self):
+        self.entries = {}
+
+    # Adds (key, entry) pairs from another table, keeping whichever entry was searched deeper
+    def merge(self, entries):
+        for key, entry in entries:
+            old = self.entries.get(key)
+            if old is None or old[0] <= entry[0]:
+                TranspositionTable.put(self, key, *entry)
+
+
+# Scores a board from the point of view of color: material plus a small bonus for central pieces and advanced pawns
+def evaluate(board, color):
+    score = 0
+    for pieces, sign in ((board.white_pieces, 1), (board.black_pieces, -1)):
+        for piece in pieces:
+            value = VALUES[piece.name] + CENTER_WEIGHTS[piece.name] * CENTER[piece.y][piece.x]
+            if piece.name == "Pawn":
+                value += 6 * (6 - piece.y if piece.color == "White" else piece.y - 1)
+            score += sign * value
+    return score if color == "White" else -score
+
+
+def in_check(board, color):
+    return board.check and board.attacking_piece is not None and board.attacking_piece.color != color
+
+
+# Iterative deepening alpha-beta (negamax) search over the Board API. Moves are played with
+# Board.make_move/unmake_move, so the board is left as it was once best_move returns
+class Search:
+    def __init__(self, table_size=1 << 18):
+        self.table = TranspositionTable(table_size)
+        self.killers = []
+        self.nodes = 0
+        self.deadline = None
+        self.path = []
+        self.root_move = None
+
+    # Returns ((x, y, new_x, new_y, promotion), score, depth) for the best move found within time_limit seconds,
+    # or (None, score, 0) when color has no moves
+    def best_move(self, board, color, time_limit=2.0, max_depth=64):
+        self.deadline = time.perf_counter() + time_limit
+        self.nodes = 0
+        self.killers = [[None, None] for i in range(max_depth + MAX_QUIESCENCE + 2)]
+        self.path = []
+        base = len(board.undo_stack)
+        moves = board.get_moves(color, PROMOTIONS)
+        if not moves:
+            return None, -MATE if in_check(board, color) else 0, 0
+        best = (self.key(moves[0]), 0, 0)
+        if len(moves) == 1:
+            return best
+        for depth in range(1, max_depth + 1):
+            try:
+                score = self.negamax(board, color, depth, -INFINITY, INFINITY, 0)
+            except TimeUp:
+                while len(board.undo_stack) > base:
+                    board.unmake_move()
+                self.path = []
+                break
+            best = (self.root_move, score, depth)
+            if score >= MATE - depth or score <= -MATE + depth:
+                break
+        return best
+
+    # Searches only the given root moves to a fixed depth, so the root can be split between processes.
+    # Returns (move, score), or None if time_limit ran out first. A score at or below alpha only means
+    # none of the moves does better than alpha
+    def search_moves(self, board, color, moves, depth, time_limit, alpha=-INFINITY):
+        self.deadline = time.perf_counter() + time_limit
+        self.nodes = 0
+        if len(self.killers) < depth + MAX_QUIESCENCE + 2:
+            self.killers = [[None, None] for i in range(depth + MAX_QUIESCENCE + 2)]
+        self.path = []
+        base = len(board.undo_stack)
+        try:
+            score = self.negamax(board, color, depth, alpha, INFINITY, 0, moves)
+        except TimeUp:
+            while len(board.undo_stack) > base:
+                board.unmake_move()
+            self.path = []
+            return None
+        return self.root_move, score
+
+    @staticmethod
+    def key(move):
+        piece, target, promotion = move
+        return piece.x, piece.y, target[0], target[1], promotion
+
+    # moves limits the root to some of its moves, the result is then not stored in the table
+    def negamax(self, board, color, depth, alpha, beta, ply, moves=None):
+        restricted = moves is not None
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.perf_counter() > self.deadline:
+            raise TimeUp()
+        if ply > 0 and board.hash in self.path:
+            return 0 # Repeating a position on the current line is a draw
+        entry = self.table.get(board.hash, ply)
+        table_move = None
+        if entry is not None:
+            table_depth, score, flag, table_move = entry
+            if ply > 0 and table_depth >= depth:
+                if flag == EXACT or (flag == LOWER and score >= beta) or (flag == UPPER and score <= alpha):
+                    return score
+        if depth <= 0:
+            return self.quiesce(board, color, alpha, beta, ply, 0)
+
+        if not restricted:
+            moves = board.get_moves(color, PROMOTIONS)
+        if not moves:
+            return -MATE + ply if in_check(board, color) else 0
+        for piece, target, promotion in moves:
+            space = board.get_space(*target)
+            if space is not None and space.name == "King":
+                if ply == 0:
+                    self.root_move = self.key((piece, target, promotion))
+                return MATE - ply # The last move left the king en prise
+        moves = self.order(board, moves, table_move, ply)
+
+        other = "Black" if color == "White" else "White"
+        original_alpha = alpha
+        best_score = -INFINITY
+        best_move = None
+        self.path.append(board.hash)
+        for move in moves:
+            piece, target, promotion = move
+            key = self.key(move)
+            capture = board.get_space(*target) is not None
+            value = board.make_move(piece, target[0], target[1], promotion)
+            try:
+                if value[0] == 2:
+                    score = MATE - ply - 1
+                else:
+                    score = -self.negamax(board, other, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.unmake_move()
+            if score > best_score:
+                best_score = score
+                best_move = key
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not capture and key != self.killers[ply][0]:
+                    self.killers[ply][1] = self.killers[ply][0]
+                    self.killers[ply][0] = key
+                break
+        self.path.pop()
+        if ply == 0:
+            self.root_move = best_move
+        if restricted:
+            return best_score
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.put(board.hash, depth, best_score, flag, best_move, ply)
+        return best_score
+
+    # Searches captures only until the position is quiet, so the evaluation is not taken mid exchange
+    def quiesce(self, board, color, alpha, beta, ply, depth):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.perf_counter() > self.deadline:
+            raise TimeUp()
+        stand_pat = evaluate(board, color)
+        if stand_pat >= beta or depth >= MAX_QUIESCENCE:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+        captures = []
+        for move in board.get_moves(color, (Queen,)):
+            space = board.get_space(*move[1])
+            if space is not None:
+                if space.name == "King":
+                    return MATE - ply
+                captures.append((VALUES[space.name] * 10 - VALUES[move[0].name] // 100, move))
+        captures.sort(key=lambda capture: -capture[0])
+        other = "Black" if color == "White" else "White"
+        for order, (piece, target, promotion) in captures:
+            value = board.make_move(piece, target[0], target[1], promotion)
+            try:
+                if value[0] == 2:
+                    score = MATE - ply - 1
+                else:
+                    score = -self.quiesce(board, other, -beta, -alpha, ply + 1, depth + 1)
+            finally:
+                board.unmake_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    # Sorts moves: the table move, then captures by most valuable victim / least valuable attacker, then killers
+    def order(self, board, moves, table_move, ply):
+        killers = self.killers[ply] if ply < len(self.killers) else (None, None)
+        scored = []
+        for move in moves:
+            piece, target, promotion = move
+            key = self.key(move)
+            space = board.get_space(*target)
+            if key == table_move:
+                score = 1000000
+            elif space is not None:
+                score = 100000 + VALUES[space.name] * 10 - VALUES[piece.name] // 100
+            elif promotion is not None:
+                score = 90000
+            elif key == killers[0]:
+                score = 80000
+            elif key == killers[1]:
+                score = 70000
+            else:
+                score = 0
+            scored.append((score, len(scored), move))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [move for score, index, move in scored]
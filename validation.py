@@ -0,0 +1,85 @@
+import argparse
+import random
+import time
+from classes import Board, Queen, Rook, Bishop, Knight
+import protocol
+
+PROMOTION_CLASSES = {"Queen": Queen, "Rook": Rook, "Bishop": Bishop, "Knight": Knight}
+
+
+# Keeps the authoritative board of one game and checks each move message against it.
+# Uses the bitboard backend, so moves that leave the mover's own king in check are refused
+class Referee:
+    def __init__(self):
+        self.board = Board(100, 250, backend="bitboard")
+        self.board.fill_board()
+        self.promotion = None # (color, x, y) of a pawn waiting for its promotion piece
+        self.result = None # Winning color or "Draw" once the game is over
+
+    # Applies a decoded message sent by the player on team ("white" or "black").
+    # Returns None if it was legal, otherwise the reason it was refused
+    def check(self, team, message):
+        color = "White" if team == "white" else "Black"
+        board = self.board
+        if self.result is not None:
+            return "The game is over"
+        if message[0] == "promotion":
+            if self.promotion is None or self.promotion != (message[1], message[3], message[4]) or message[1] != color:
+                return "No pawn to promote there"
+            board.add_piece(PROMOTION_CLASSES[message[2]](message[1], message[3], message[4]))
+            self.promotion = None
+            self.result = board.result()
+            return None
+        if message[0] != "move":
+            return "Unexpected %s message" % message[0]
+        if self.promotion is not None:
+            return "Waiting for the promotion piece"
+        if board.turn != color:
+            return "It is not your turn"
+        x, y, new_x, new_y = message[1:]
+        piece = board.get_space(x, y)
+        if piece is None or piece.color != color:
+            return "No piece of yours on that square"
+        if (new_x, new_y) not in piece.get_valid_moves(board):
+            return "Illegal move"
+        value = piece.move(board, new_x, new_y)
+        if value[0] == 3:
+            self.promotion = (color, new_x, new_y)
+        else:
+            self.result = board.result()
+        return None
+
+
+# Plays random games through Referee.check and reports how many moves per second it validates
+def benchmark(games, seed):
+    generator = random.Random(seed)
+    checked = 0
+    elapsed = 0.0
+    for game in range(games):
+        referee = Referee()
+        board = referee.board
+        plies = 0
+        while referee.result is None and plies < 300:
+            moves = board.get_moves(board.turn)
+            piece, target, promotion = generator.choice(moves)
+            team = piece.color.lower()
+            messages = [("move", piece.x, piece.y, target[0], target[1])]
+            if promotion is not None:
+                messages.append(("promotion", piece.color, promotion.__name__, target[0], target[1]))
+            for message in messages:
+                start = time.perf_counter()
+                error = referee.check(team, message)
+                elapsed += time.perf_counter() - start
+                checked += 1
+                if error is not None:
+                    raise AssertionError("Legal move %s refused: %s" % (protocol.encode_text(message), error))
+            plies += 1 # Random games can wander a long time, stop them after 300 plies
+    print("%d games, %d messages validated in %.2fs, %.0f messages/s" % (games, checked, elapsed, checked / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how fast the referee validates the moves of random games")
+    parser.add_argument("games", nargs="?", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    benchmark(args.games, args.seed)
@@ -0,0 +1,31 @@
+import random
+from bitboard import COLORS, KINDS
+
+# Fixed seed so every process (and every run) agrees on the keys
+_random = random.Random(181)
+
+# PIECE_KEYS[color][kind][y * 8 + x], color and kind numbered as in bitboard
+PIECE_KEYS = tuple(tuple(tuple(_random.getrandbits(64) for sq in range(64)) for kind in range(6)) for color in range(2))
+# One key per combination of the four castling rights bits
+CASTLING_KEYS = tuple(_random.getrandbits(64) for rights in range(16))
+EN_PASSANT_KEYS = tuple(_random.getrandbits(64) for x in range(8))
+BLACK_TO_MOVE = _random.getrandbits(64)
+
+
+def piece_key(piece, x, y):
+    return PIECE_KEYS[COLORS.index(piece.color)][KINDS[piece.name]][y * 8 + x]
+
+
+# Computes a Board's hash from scratch, used to check the incrementally maintained Board.hash
+def hash_board(board):
+    value = CASTLING_KEYS[board.castling]
+    for y in range(8):
+        for x in range(8):
+            piece = board.get_space(x, y)
+            if piece is not None:
+                value ^= piece_key(piece, x, y)
+    if board.en_passant is not None:
+        value ^= EN_PASSANT_KEYS[board.en_passant.x]
+    if board.turn == "Black":
+        value ^= BLACK_TO_MOVE
+    return value